@@ -0,0 +1,77 @@
+from glob import glob
+
+import QRCodeDetection as detection
+
+
+# This checks applyBoxSmooth, which computeQRCodeBoundingBox uses in place of applying applyGaussianSmooth eleven
+# times, against that iterated 3x3 kernel on every image under images/covid19QRCode. The box filter cascade is an
+# approximation, so the check is that it stays close: within MAX_DIFFERENCE of the reference away from the border
+# (the two treat the border differently), with at most MAX_FLIPPED of those pixels on the other side of the
+# threshold, and with a QR code bounding box within MAX_BOX_SHIFT pixels of the one the reference gives.
+# The python and numpy versions of applyBoxSmooth must also give identical results.
+# Run it from the top of the repository: python BoxSmoothAccuracyCheck.py (it takes a minute or two).
+
+ITERATIONS = 11
+MARGIN = 12
+MAX_DIFFERENCE = 3
+MAX_FLIPPED = 0.006
+MAX_BOX_SHIFT = 1
+THRESHOLD = 30
+
+
+# This method runs the stages after smoothing, as computeQRCodeBoundingBox does, and returns the bounding box
+def computeBoundingBoxFromSmoothed(w, h, smoothed):
+    stages = detection.stage_backends['python']
+    thresholding_operation = stages['applyThresholdingOperation'](w, h, smoothed, THRESHOLD)
+    closing_array = stages['applyClosing'](thresholding_operation, w, h)
+    (connected_array, statistics) = stages['computeConnectedComponentLabelingWithStatistics'](closing_array, w, h)
+    return stages['computeMainObjectOutline'](connected_array, statistics, w, h)[0]
+
+
+def checkImage(filename):
+    (w, h, rgb_rows, greyscale_array) = detection.readRGBImageToRowsAndGreyImage(filename)
+    horizontal_edge = detection.getHorizontalEdges(w, h, greyscale_array)
+    vertical_edge = detection.getVerticalEdges(w, h, greyscale_array)
+    gradient_magnitude = detection.getGradientMagnitude(w, h, horizontal_edge, vertical_edge)
+
+    reference = gradient_magnitude
+    for i in range(ITERATIONS):
+        reference = detection.applyGaussianSmooth(w, h, reference)
+    box = detection.applyBoxSmooth(w, h, gradient_magnitude, ITERATIONS)
+
+    box_numpy = detection.applyBoxSmoothNumpy(w, h, gradient_magnitude, ITERATIONS)
+    assert box_numpy.tolist() == box, "{}: python and numpy applyBoxSmooth differ".format(filename)
+
+    largest_difference = 0
+    flipped = 0
+    for i in range(MARGIN, h - MARGIN):
+        for j in range(MARGIN, w - MARGIN):
+            largest_difference = max(largest_difference, abs(box[i][j] - reference[i][j]))
+            if (box[i][j] < THRESHOLD) != (reference[i][j] < THRESHOLD):
+                flipped += 1
+    flipped_fraction = flipped / ((h - 2 * MARGIN) * (w - 2 * MARGIN))
+
+    reference_box = computeBoundingBoxFromSmoothed(w, h, reference)
+    box_box = computeBoundingBoxFromSmoothed(w, h, box)
+    box_shift = max(abs(a - b) for (a, b) in zip(reference_box, box_box))
+
+    print("{}: largest difference {}, {:.3%} flipped at the threshold, bounding box {} against {}".format(
+        filename, largest_difference, flipped_fraction, box_box, reference_box))
+    assert largest_difference <= MAX_DIFFERENCE, "{}: difference {} over {}".format(
+        filename, largest_difference, MAX_DIFFERENCE)
+    assert flipped_fraction <= MAX_FLIPPED, "{}: {:.3%} flipped, over {:.3%}".format(
+        filename, flipped_fraction, MAX_FLIPPED)
+    assert box_shift <= MAX_BOX_SHIFT, "{}: bounding box {} is more than {} pixel from {}".format(
+        filename, box_box, MAX_BOX_SHIFT, reference_box)
+
+
+def main():
+    filenames = sorted(glob("./images/covid19QRCode/**/*.png", recursive=True))
+    assert filenames, "no images found; run this from the top of the repository"
+    for filename in filenames:
+        checkImage(filename)
+    print("applyBoxSmooth matches {} applyGaussianSmooth passes on {} images".format(ITERATIONS, len(filenames)))
+
+
+if __name__ == "__main__":
+    main()
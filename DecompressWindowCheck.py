@@ -0,0 +1,58 @@
+import random
+import struct
+import time
+import zlib
+
+import imageIO.png
+
+
+# This checks that reading a PNG file whose pixels are all in one large IDAT chunk takes time in proportion to the
+# size of the image. The reader decompresses in windows of a few scanlines; when the scanlines are short and a chunk
+# is large, feeding the whole rest of the chunk to zlib for each window took time that grew with the square of the
+# chunk's size. Images 8 pixels wide and 250,000 to 2,000,000 rows high are made with a single IDAT chunk, and
+# read back: the rows must be right, and the time for 8 times the rows must be at most MAX_GROWTH times as long
+# (it would be about 64 times as long if the time grew with the square of the size).
+# Run it from the top of the repository: python DecompressWindowCheck.py
+
+WIDTH = 8
+HEIGHTS = (250000, 2000000)
+MAX_GROWTH = 16
+
+
+def makeChunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+# This method returns the pixels of a greyscale image of random values (which hardly compress, so the compressed
+# chunk is large), and a PNG file of it, all of whose compressed pixels are in one IDAT chunk
+def makeSingleChunkPNG(width, height):
+    pixels = random.Random(height).randbytes(width * height)
+    scanlines = b''.join(b'\0' + pixels[y * width: (y + 1) * width] for y in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    png_file = (imageIO.png.signature + makeChunk(b'IHDR', header) +
+                makeChunk(b'IDAT', zlib.compress(scanlines)) + makeChunk(b'IEND', b''))
+    return (pixels, png_file)
+
+
+def timeRead(height):
+    (pixels, data) = makeSingleChunkPNG(WIDTH, height)
+    start = time.perf_counter()
+    (width, rows_read, rows, info) = imageIO.png.Reader(bytes=data).read()
+    rows = list(rows)
+    elapsed = time.perf_counter() - start
+    assert len(rows) == height, "{} rows read, not {}".format(len(rows), height)
+    assert b''.join(rows) == pixels, "the rows read are wrong"
+    print("{} by {} image in one IDAT chunk read in {:.2f}s".format(WIDTH, height, elapsed))
+    return elapsed
+
+
+def main():
+    (small, large) = (timeRead(height) for height in HEIGHTS)
+    growth = large / small
+    assert growth <= MAX_GROWTH, "{} times the rows took {:.1f} times as long".format(
+        HEIGHTS[1] // HEIGHTS[0], growth)
+    print("{} times the rows took {:.1f} times as long".format(HEIGHTS[1] // HEIGHTS[0], growth))
+
+
+if __name__ == "__main__":
+    main()
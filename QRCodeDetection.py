@@ -1,3 +1,4 @@
+from array import array
 from urllib.parse import urlparse
 
 from PIL import Image
@@ -5,34 +6,107 @@ from matplotlib import pyplot
 from matplotlib.patches import Rectangle, Polygon
 from pyzbar.pyzbar import decode
 
+import imageIO.cache
 import imageIO.png
 
 
 
-#This is the queue class for Connected Conponent
-class Queue:
-    def __init__(self):
-        self.items = []
-
-    def isEmpty(self):
-        return self.items == []
-
-    def enqueue(self, item):
-        self.items.insert(0,item)
-
-    def dequeue(self):
-        return self.items.pop()
-
-    def size(self):
-        return len(self.items)
-
-
 def createInitializedGreyscalePixelArray(image_width, image_height, initValue = 0):
 
     new_array = [[initValue for x in range(image_width)] for y in range(image_height)]
     return new_array
 
 
+# This class is a greyscale image stored in one flat buffer instead of a list of lists of ints.
+# kind 'B' holds 8 bit values (luma, thresholded images), kind 'h' signed 16 bit values (Sobel edges, gradients),
+# kind 'i' signed 32 bit values (component labels) and kind 'bit' one bit per pixel (binary masks), packed eight
+# to a byte with the leftmost pixel in the high bit, the same as a row of a 1 bit png.
+# stride is the number of values (bytes for 'bit') from one row to the next.
+# image[i][j] reads and writes the pixel in row i, column j, just as it does for a pixel array,
+# so the stage functions accept either kind of image and can be ported to GreyImage one by one.
+class GreyImage:
+    def __init__(self, width, height, kind='B', initValue=0, stride=None):
+        self.width = width
+        self.height = height
+        self.kind = kind
+        if kind == 'bit':
+            self.stride = stride or (width + 7) // 8
+            self.data = bytearray([0xff if initValue else 0]) * (self.stride * height)
+            self.rows = [BitRow(self.data, i * self.stride, width) for i in range(height)]
+        elif kind in ('B', 'h', 'i'):
+            self.stride = stride or width
+            self.data = array(kind, [initValue]) * (self.stride * height)
+            view = memoryview(self.data)
+            self.rows = [view[i * self.stride: i * self.stride + width] for i in range(height)]
+        else:
+            raise ValueError("kind must be 'B', 'h', 'i' or 'bit', not {!r}".format(kind))
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    # the number of bytes of pixel data
+    def nbytes(self):
+        return self.data.itemsize * len(self.data) if self.kind != 'bit' else len(self.data)
+
+    # This method converts the image back into a pixel array (a list of lists), for stages not yet ported
+    def toPixelArray(self):
+        return [list(row) for row in self.rows]
+
+    # This method makes a GreyImage holding a copy of a pixel array (a list of lists)
+    @classmethod
+    def fromPixelArray(cls, pixel_array, kind='B'):
+        height = len(pixel_array)
+        width = len(pixel_array[0]) if height else 0
+        image = cls(width, height, kind)
+        if kind == 'bit':
+            padding = image.stride * 8 - width
+            for i, row in enumerate(pixel_array):
+                bits = 0
+                for value in row:
+                    bits = bits << 1 | (value != 0)
+                start = i * image.stride
+                image.data[start: start + image.stride] = (bits << padding).to_bytes(image.stride, 'big')
+        else:
+            for i, row in enumerate(pixel_array):
+                image.rows[i][:] = array(kind, row)
+        return image
+
+
+# This class is one row of a bit packed GreyImage; reading a pixel gives 0 or 1, and writing any non zero value sets it
+class BitRow:
+    def __init__(self, data, offset, width):
+        self.data = data
+        self.offset = offset
+        self.width = width
+
+    def __len__(self):
+        return self.width
+
+    def __getitem__(self, j):
+        if not 0 <= j < self.width:
+            raise IndexError("pixel index out of range")
+        return (self.data[self.offset + (j >> 3)] >> (7 - (j & 7))) & 1
+
+    def __setitem__(self, j, value):
+        if not 0 <= j < self.width:
+            raise IndexError("pixel index out of range")
+        mask = 0x80 >> (j & 7)
+        if value:
+            self.data[self.offset + (j >> 3)] |= mask
+        else:
+            self.data[self.offset + (j >> 3)] &= ~mask & 0xff
+
+    def __iter__(self):
+        for j in range(self.width):
+            yield (self.data[self.offset + (j >> 3)] >> (7 - (j & 7))) & 1
+
+
 # This method applies dilation
 def applyDilation(pixel_array, w, h):
     dilation_array = createInitializedGreyscalePixelArray(w, h)
@@ -90,31 +164,40 @@ def readRGBImageToSeparatePixelArrays(input_filename):
     pixel_array_b = []
 
     for row in rgb_image_rows:
-        pixel_row_r = []
-        pixel_row_g = []
-        pixel_row_b = []
-        r = 0
-        g = 0
-        b = 0
-        for elem in range(len(row)):
-            # RGB triplets are stored consecutively in image_rows
-            if elem % 3 == 0:
-                r = row[elem]
-            elif elem % 3 == 1:
-                g = row[elem]
-            else:
-                b = row[elem]
-                pixel_row_r.append(r)
-                pixel_row_g.append(g)
-                pixel_row_b.append(b)
-
-        pixel_array_r.append(pixel_row_r)
-        pixel_array_g.append(pixel_row_g)
-        pixel_array_b.append(pixel_row_b)
+        # RGB triplets are stored consecutively in image_rows, so every third value belongs to the same channel
+        pixel_array_r.append(list(row[0::3]))
+        pixel_array_g.append(list(row[1::3]))
+        pixel_array_b.append(list(row[2::3]))
 
     return (image_width, image_height, pixel_array_r, pixel_array_g, pixel_array_b)
 
 
+# this function reads a png file once and returns width, height, its rows of 8 bit RGB triplets (for display;
+# RGBA quadruplets if the image has transparency), and a GreyImage of its luma (for detection), computed from those
+# rows the same way the png reader's asGreyscale8 does
+# if a decode cache (imageIO.cache.DecodeCache) is given, an image that was read before is not decoded again
+def readRGBImageToRowsAndGreyImage(input_filename, cache=None):
+
+    image_reader = imageIO.png.Reader(filename=input_filename)
+    # only the chunks before the pixel data are read, to find out whether the image has transparency
+    image_reader.preamble()
+    if image_reader.alpha or image_reader.trns is not None:
+        method = 'asRGBA8'
+    else:
+        method = 'asRGB8'
+    if cache is not None:
+        (image_width, image_height, rgb_image_rows, rgb_image_info) = cache.read(input_filename, method)
+    else:
+        (image_width, image_height, rgb_image_rows, rgb_image_info) = getattr(image_reader, method)()
+    rgb_image_rows = list(rgb_image_rows)
+
+    image = GreyImage(image_width, image_height)
+    for i, row in enumerate(imageIO.png.luma8_rows(rgb_image_rows, rgb_image_info['planes'])):
+        image.rows[i][:] = row
+
+    return (image_width, image_height, rgb_image_rows, image)
+
+
 # This method packs together three individual pixel arrays for r, g and b values into a single array that is fit for
 # use in matplotlib's imshow method
 def prepareRGBImageForImshowFromIndividualArrays(r,g,b,w,h):
@@ -131,11 +214,21 @@ def prepareRGBImageForImshowFromIndividualArrays(r,g,b,w,h):
     return rgbImage
 
 
+# This method turns rows of RGB triplets (or RGBA quadruplets) into an array fit for matplotlib's imshow,
+# without a list for every pixel
+def prepareRGBImageForImshowFromRows(rgb_rows, w, h):
+    import numpy
+
+    return numpy.frombuffer(b''.join(bytes(row) for row in rgb_rows), dtype=numpy.uint8).reshape(h, w, -1)
+
+
 # This method takes a greyscale pixel array and writes it into a png file
-def writeGreyscalePixelArraytoPNG(output_filename, pixel_array, image_width, image_height):
+# filter_type is passed to the png writer: 0 (the default) writes fastest, while a filter (1 to 4, or 'sum' to choose
+# one for each row) is slower to write but can make a smaller file, mostly for images with large flat areas like masks
+def writeGreyscalePixelArraytoPNG(output_filename, pixel_array, image_width, image_height, filter_type=0):
     # now write the pixel array as a greyscale png
     file = open(output_filename, 'wb')  # binary mode is important
-    writer = imageIO.png.Writer(image_width, image_height, greyscale=True)
+    writer = imageIO.png.Writer(image_width, image_height, greyscale=True, filter_type=filter_type)
     writer.write(file, pixel_array)
     file.close()
 
@@ -194,6 +287,73 @@ def applyGaussianSmooth(w,h,g):
     return result_array
 
 
+# This method returns the widths of the box filters that, applied one after the other, blur about as much as
+# applying applyGaussianSmooth iterations times: each of those passes adds a variance of 1/2 along each direction,
+# and a box of odd width n adds (n * n - 1) / 12. The boxes are all of two neighbouring odd widths, with as many of
+# the narrower ones as brings the total variance closest.
+def getBoxWidthsForGaussianSmooth(iterations, passes=4):
+    variance = iterations / 2
+    narrow = int((12 * variance / passes + 1) ** 0.5)
+    if narrow % 2 == 0:
+        narrow -= 1
+    narrow = max(narrow, 1)
+    wide = narrow + 2
+    narrow_count = round((passes * wide * wide - passes - 12 * variance) / (wide * wide - narrow * narrow))
+    narrow_count = min(max(narrow_count, 0), passes)
+    return [narrow] * narrow_count + [wide] * (passes - narrow_count)
+
+
+# This method divides integers and rounds halves to the even neighbour, as round(total / divisor) does, but exactly
+def roundDivide(total, divisor):
+    (quotient, remainder) = divmod(total, divisor)
+    if 2 * remainder > divisor or (2 * remainder == divisor and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
+
+# This method returns the running sums of values over windows of width 2 * radius + 1 centred on each value,
+# counting values beyond either end as 0; each sum is the previous one plus the value entering the window
+# less the value leaving it, so the cost does not depend on the width
+def getRunningSums(values, radius):
+    n = len(values)
+    sums = [0] * n
+    total = sum(values[:radius])
+    for j in range(n):
+        if j + radius < n:
+            total += values[j + radius]
+        if j - radius > 0:
+            total -= values[j - radius - 1]
+        sums[j] = total
+    return sums
+
+
+# This method takes image width, height and the gradient magnitude and blurs it about as much as applying
+# applyGaussianSmooth iterations times does, with a cascade of passes box filters in each direction, whose cost does
+# not depend on how wide the blur is. Like applyGaussianSmooth, it leaves the pixels on the border at 0.
+def applyBoxSmooth(w, h, g, iterations=11, passes=4):
+    result_array = createInitializedGreyscalePixelArray(w, h)
+    if h <= 2 or w <= 2:
+        return result_array
+    widths = getBoxWidthsForGaussianSmooth(iterations, passes)
+    # the sums are kept unnormalised, and divided once at the end
+    divisor = 1
+    for width in widths:
+        divisor *= width * width
+
+    rows = [list(g[i]) for i in range(h)]
+    for width in widths:
+        rows = [getRunningSums(row, width // 2) for row in rows]
+    columns = [list(column) for column in zip(*rows)]
+    for width in widths:
+        columns = [getRunningSums(column, width // 2) for column in columns]
+
+    for j in range(1, w - 1):
+        column = columns[j]
+        for i in range(1, h - 1):
+            result_array[i][j] = roundDivide(column[i], divisor)
+    return result_array
+
+
 # This method takes image width, height and a greyscale array and apply thresholding operation with thresholding number 1
 # and return the result array
 def applyThresholdingOperation(w,h,g,t=30):
@@ -218,48 +378,105 @@ def applyClosing(pixel_array, w, h):
 
 
 # This method takes image width, height and a binary greyscale array and get all the connnected objects.
+# It returns a GreyImage of labels and a dict from each label to the number of pixels of that object.
 def computeConnectedComponentLabeling(pixel_array, w, h):
-    result_array = createInitializedGreyscalePixelArray(w, h)
-    visited_pixel = createInitializedGreyscalePixelArray(w, h)
-    key = 1
-    result_dict = {}
+    (result_array, statistics) = computeConnectedComponentLabelingWithStatistics(pixel_array, w, h)
+    result_dict = {key: statistics[key]['area'] for key in statistics}
+    return (result_array, result_dict)
+
+
+# This method labels the 4-connected objects of a binary array in two passes, numbering them in the order their
+# first pixel is met in a row by row scan. The first pass gives each pixel the label of its left or upper
+# neighbour, or a new label, noting with union-find which labels meet; the second pass replaces each label by
+# the number of its object. Both the labels (a GreyImage of kind 'i') and, for each object, a dict of its
+# area, bounding_box (min_w, min_h, max_w, max_h), centroid (x, y) and perimeter (the number of pixel sides
+# it shares with the background or the image border) are returned.
+def computeConnectedComponentLabelingWithStatistics(pixel_array, w, h):
+    result_array = GreyImage(w, h, 'i')
+    labels = result_array.data
+    # per provisional label: parent label, area, sums of x and y, min_w, min_h, max_w, max_h and perimeter
+    parent = [0]
+    area = [0]
+    sum_x = [0]
+    sum_y = [0]
+    min_w = [0]
+    min_h = [0]
+    max_w = [0]
+    max_h = [0]
+    perimeter = [0]
+
+    def find(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
     for i in range(h):
+        row = pixel_array[i]
+        start = i * w
         for j in range(w):
-            if pixel_array[i][j] != 0 and visited_pixel[i][j] == 0:
-                value = pixel_array[i][j]
-                queue = Queue()
-                queue.enqueue([i,j])
-                result_array[i][j] = key
-                visited_pixel[i][j] = 255
-                result_dict[key] = 1
-                while not queue.isEmpty():
-                    index = queue.dequeue()
-                    if index[0]-1 in range(h) and index[1] in range(w):
-                        if pixel_array[index[0]-1][index[1]] != 0 and visited_pixel[index[0]-1][index[1]] == 0:
-                            queue.enqueue([index[0]-1, index[1]])
-                            visited_pixel[index[0]-1][index[1]] = 1
-                            result_array[index[0]-1][index[1]] = key
-                            result_dict[key] = result_dict[key] + 1
-                    if index[0] in range(h) and index[1]-1 in range(w):
-                        if pixel_array[index[0]][index[1]-1] != 0 and visited_pixel[index[0]][index[1]-1] == 0:
-                            queue.enqueue([index[0], index[1]-1])
-                            visited_pixel[index[0]][index[1]-1] = 1
-                            result_array[index[0]][index[1]-1] = key
-                            result_dict[key] = result_dict[key] + 1
-                    if index[0] in range(h) and index[1]+1 in range(w):
-                        if pixel_array[index[0]][index[1]+1] != 0 and visited_pixel[index[0]][index[1]+1] == 0:
-                            queue.enqueue([index[0], index[1]+1])
-                            visited_pixel[index[0]][index[1]+1] = 1
-                            result_array[index[0]][index[1]+1] = key
-                            result_dict[key] = result_dict[key] + 1
-                    if index[0]+1 in range(h) and index[1] in range(w):
-                        if pixel_array[index[0]+1][index[1]] != 0 and visited_pixel[index[0]+1][index[1]] == 0:
-                            queue.enqueue([index[0]+1, index[1]])
-                            visited_pixel[index[0]+1][index[1]] = 1
-                            result_array[index[0]+1][index[1]] = key
-                            result_dict[key] = result_dict[key] + 1
-                key = key + 1
-    return (result_array, result_dict)
+            if row[j] == 0:
+                continue
+            left = labels[start + j - 1] if j > 0 else 0
+            up = labels[start + j - w] if i > 0 else 0
+            if left and up:
+                label = left
+                left_root = find(left)
+                up_root = find(up)
+                if left_root != up_root:
+                    # the smaller label, met first in the scan, stays the root
+                    parent[max(left_root, up_root)] = min(left_root, up_root)
+            elif left or up:
+                label = left or up
+                perimeter[label] += 2
+            else:
+                label = len(parent)
+                parent.append(label)
+                area.append(0)
+                sum_x.append(0)
+                sum_y.append(0)
+                min_w.append(j)
+                min_h.append(i)
+                max_w.append(j)
+                max_h.append(i)
+                perimeter.append(4)
+            labels[start + j] = label
+            area[label] += 1
+            sum_x[label] += j
+            sum_y[label] += i
+            if j < min_w[label]:
+                min_w[label] = j
+            if j > max_w[label]:
+                max_w[label] = j
+            max_h[label] = i
+
+    # roots are numbered in increasing order, which is the order their objects are first met in
+    key_of = [0] * len(parent)
+    statistics = {}
+    for label in range(1, len(parent)):
+        root = find(label)
+        if root == label:
+            key = len(statistics) + 1
+            statistics[key] = {'area': 0, 'sum_x': 0, 'sum_y': 0, 'bounding_box': (w, h, 0, 0), 'perimeter': 0}
+        else:
+            key = key_of[root]
+        key_of[label] = key
+        object_statistics = statistics[key]
+        object_statistics['area'] += area[label]
+        object_statistics['sum_x'] += sum_x[label]
+        object_statistics['sum_y'] += sum_y[label]
+        object_statistics['perimeter'] += perimeter[label]
+        (box_min_w, box_min_h, box_max_w, box_max_h) = object_statistics['bounding_box']
+        object_statistics['bounding_box'] = (min(box_min_w, min_w[label]), min(box_min_h, min_h[label]),
+                                             max(box_max_w, max_w[label]), max(box_max_h, max_h[label]))
+    for object_statistics in statistics.values():
+        object_statistics['centroid'] = (object_statistics.pop('sum_x') / object_statistics['area'],
+                                         object_statistics.pop('sum_y') / object_statistics['area'])
+
+    for n in range(w * h):
+        if labels[n]:
+            labels[n] = key_of[labels[n]]
+    return (result_array, statistics)
 
 
 # This method detects four vortexes of possible object from a binary array
@@ -331,29 +548,488 @@ def computeMainObjectEdge(pixel_array, w, h):
     return result_array
 
 
+# This method finds the biggest object from the labels and statistics of computeConnectedComponentLabelingWithStatistics
+# and returns its outline in one go, looking only at the pixels in and just around the object's bounding box,
+# instead of building the full size arrays of computeMainObject and computeMainObjectEdge and scanning them.
+# It returns (bounding_box, contour_points, mask_crop, crop_box): the contour is the background pixels touching the
+# object (the edge computeMainObjectEdge finds), contour_points lists them as (x, y) in scan order and bounding_box
+# is their (min_w, min_h, max_w, max_h), as computeVortexes gives; mask_crop is a bit GreyImage of the object
+# over crop_box, the (min_w, min_h, max_w, max_h) of the object's bounding box grown by one pixel.
+def computeMainObjectOutline(label_array, statistics, w, h):
+    num = 0
+    largest = 0
+    for key in statistics:
+        if statistics[key]['area'] > largest:
+            largest = statistics[key]['area']
+            num = key
+    if num == 0:
+        # no objects: the background is the biggest object, it fills the image and has no edge
+        return ((w, h, 0, 0), [], GreyImage(w, h, 'bit', 1), (0, 0, w - 1, h - 1))
+
+    (min_w, min_h, max_w, max_h) = statistics[num]['bounding_box']
+    (x0, y0, x1, y1) = crop_box = (max(min_w - 1, 0), max(min_h - 1, 0), min(max_w + 1, w - 1), min(max_h + 1, h - 1))
+    crop_width = x1 - x0 + 1
+    crop_height = y1 - y0 + 1
+    mask_crop = GreyImage(crop_width, crop_height, 'bit')
+    padding = mask_crop.stride * 8 - crop_width
+    all_columns = (1 << crop_width) - 1
+
+    # each row of the object is held as an int, with a bit for each column of the crop, leftmost in the highest bit
+    mask_rows = []
+    for i in range(crop_height):
+        row = label_array[y0 + i]
+        bits = 0
+        for j in range(x0, x1 + 1):
+            bits = bits << 1 | (row[j] == num)
+        mask_rows.append(bits)
+        start = i * mask_crop.stride
+        mask_crop.data[start: start + mask_crop.stride] = (bits << padding).to_bytes(mask_crop.stride, 'big')
+
+    contour_points = []
+    for i in range(crop_height):
+        touching = 0
+        for k in (i - 1, i, i + 1):
+            if 0 <= k < crop_height:
+                touching |= mask_rows[k] | mask_rows[k] << 1 | mask_rows[k] >> 1
+        contour = touching & all_columns & ~mask_rows[i]
+        if contour:
+            bits = format(contour, '0{}b'.format(crop_width))
+            contour_points.extend((x0 + j, y0 + i) for j in range(crop_width) if bits[j] == '1')
+
+    if not contour_points:
+        return ((w, h, 0, 0), contour_points, mask_crop, crop_box)
+    xs = [x for (x, y) in contour_points]
+    bounding_box = (min(xs), contour_points[0][1], max(xs), contour_points[-1][1])
+    return (bounding_box, contour_points, mask_crop, crop_box)
+
+
+# The numpy backend: each stage below computes the same result as the pure python stage of the same name
+# (which stays the reference implementation), rounding halves to even exactly as python's round does.
+# They accept a pixel array, a GreyImage or a numpy array, and return a numpy array.
+# numpy is imported inside each of them, so it is only needed when this backend is used.
+
+# This method returns the pixel values of a pixel array, GreyImage or numpy array as an (h, w) numpy array
+def asNumpyArray(pixel_array):
+    import numpy
+
+    if isinstance(pixel_array, GreyImage):
+        if pixel_array.kind == 'bit':
+            bits = numpy.frombuffer(pixel_array.data, dtype=numpy.uint8).reshape(pixel_array.height, pixel_array.stride)
+            return numpy.unpackbits(bits, axis=1)[:, :pixel_array.width]
+        values = numpy.frombuffer(pixel_array.data, dtype=pixel_array.kind)
+        return values.reshape(pixel_array.height, pixel_array.stride)[:, :pixel_array.width]
+    return numpy.asarray(pixel_array)
+
+
+# This method divides integers by 2**shift and rounds halves to the even neighbour, as round(x / 2**shift) does:
+# adding half - 1, plus one more when the quotient is odd, rounds exactly the right halves up
+def roundDividePowerOfTwoNumpy(x, shift):
+    result = x >> shift
+    result &= 1
+    result += (1 << (shift - 1)) - 1
+    result += x
+    result >>= shift
+    return result
+
+
+# This method adds weight times each of the terms to total, in place, and returns total (a new array if it is None)
+def accumulateWeightedNumpy(total, terms, weights):
+    for term, weight in zip(terms, weights):
+        if weight == 0:
+            continue
+        if total is None:
+            total = term * weight
+        elif weight == 1:
+            total += term
+        elif weight == -1:
+            total -= term
+        else:
+            total += term * weight
+    return total
+
+
+# This method returns the sum of the 3x3 neighbourhood of every interior pixel, weighted by the outer product of
+# row_weights and column_weights, in an (h - 2, w - 2) array
+def weightedNeighbourhoodSumNumpy(g, row_weights, column_weights):
+    import numpy
+
+    g = asNumpyArray(g).astype(numpy.int32)
+    h, w = g.shape
+    rows = accumulateWeightedNumpy(None, (g[k:h - 2 + k] for k in range(3)), row_weights)
+    return accumulateWeightedNumpy(None, (rows[:, k:w - 2 + k] for k in range(3)), column_weights)
+
+
+def getGreyscalePixelArrayfromPixelArrayNumpy(w, h, r, g, b):
+    import numpy
+
+    # the same floating point operations, in the same order, as the reference
+    n = 0.299 * asNumpyArray(r) + 0.587 * asNumpyArray(g) + 0.114 * asNumpyArray(b)
+    return numpy.rint(n).astype(numpy.uint8)
+
+
+def getHorizontalEdgesNumpy(w, h, g):
+    import numpy
+
+    result_array = numpy.zeros((h, w), dtype=numpy.int16)
+    if h > 2 and w > 2:
+        result_array[1:-1, 1:-1] = roundDividePowerOfTwoNumpy(weightedNeighbourhoodSumNumpy(g, (1, 0, -1), (1, 2, 1)), 3)
+    return result_array
+
+
+def getVerticalEdgesNumpy(w, h, g):
+    import numpy
+
+    result_array = numpy.zeros((h, w), dtype=numpy.int16)
+    if h > 2 and w > 2:
+        result_array[1:-1, 1:-1] = roundDividePowerOfTwoNumpy(weightedNeighbourhoodSumNumpy(g, (1, 2, 1), (-1, 0, 1)), 3)
+    return result_array
+
+
+def getGradientMagnitudeNumpy(w, h, horizontal, vertical):
+    import numpy
+
+    horizontal = asNumpyArray(horizontal).astype(numpy.int16)
+    vertical = asNumpyArray(vertical).astype(numpy.int16)
+    return numpy.abs(horizontal) + numpy.abs(vertical)
+
+
+def applyGaussianSmoothNumpy(w, h, g):
+    import numpy
+
+    result_array = numpy.zeros((h, w), dtype=numpy.int16)
+    if h > 2 and w > 2:
+        result_array[1:-1, 1:-1] = roundDividePowerOfTwoNumpy(weightedNeighbourhoodSumNumpy(g, (1, 2, 1), (1, 2, 1)), 4)
+    return result_array
+
+
+# This method divides integers and rounds halves to the even neighbour, as roundDivide does
+def roundDivideNumpy(total, divisor):
+    (quotient, remainder) = divmod(total, divisor)
+    return quotient + ((2 * remainder > divisor) | ((2 * remainder == divisor) & (quotient % 2 == 1)))
+
+
+# This method replaces values by their running sums over windows of width 2 * radius + 1 along the given axis, as
+# getRunningSums does, by differencing a cumulative sum; scratch is an array at least 2 * radius + 1 longer along
+# that axis, reused so that no pass allocates memory
+def getRunningSumsNumpy(values, radius, axis, scratch):
+    import numpy
+
+    count = values.shape[axis]
+    width = 2 * radius + 1
+
+    def along(start, stop):
+        index = [slice(0, values.shape[0]), slice(0, values.shape[1])]
+        index[axis] = slice(start, stop)
+        return tuple(index)
+
+    padded = scratch[along(0, count + width)]
+    padded[along(0, radius + 1)] = 0
+    padded[along(radius + 1, radius + 1 + count)] = values
+    padded[along(radius + 1 + count, count + width)] = 0
+    numpy.cumsum(padded, axis=axis, out=padded)
+    numpy.subtract(padded[along(width, count + width)], padded[along(0, count)], out=values)
+    return values
+
+
+def applyBoxSmoothNumpy(w, h, g, iterations=11, passes=4):
+    import numpy
+
+    result_array = numpy.zeros((h, w), dtype=numpy.int16)
+    if h <= 2 or w <= 2:
+        return result_array
+    widths = getBoxWidthsForGaussianSmooth(iterations, passes)
+    divisor = 1
+    for width in widths:
+        divisor *= width * width
+
+    # the cumulative sums may wrap around, but the differences of them are right as long as the sums they give fit
+    sums = asNumpyArray(g).astype(numpy.int32 if divisor * 32767 < 2 ** 31 else numpy.int64)
+    widest = max(widths)
+    scratch = numpy.empty((h + widest, w + widest), dtype=sums.dtype)
+    for axis in (1, 0):
+        for width in widths:
+            getRunningSumsNumpy(sums, width // 2, axis, scratch)
+    result_array[1:-1, 1:-1] = roundDivideNumpy(sums[1:-1, 1:-1], divisor)
+    return result_array
+
+
+def applyThresholdingOperationNumpy(w, h, g, t=30):
+    import numpy
+
+    return numpy.where(asNumpyArray(g) < t, 0, 255).astype(numpy.uint8)
+
+
+# This method returns, for every pixel, whether any pixel in its 3x3 neighbourhood (within the image) is non zero;
+# with include_centre=False the pixel itself is left out
+def anyNeighbourNonZeroNumpy(pixel_array, include_centre=True):
+    import numpy
+
+    nonzero = asNumpyArray(pixel_array) != 0
+    padded = numpy.zeros((nonzero.shape[0] + 2, nonzero.shape[1] + 2), dtype=bool)
+    padded[1:-1, 1:-1] = nonzero
+    # the horizontal neighbourhood first, then the vertical, as the 3x3 window is separable
+    rows = padded[:, :-2] | padded[:, 1:-1] | padded[:, 2:]
+    result = rows[:-2] | rows[1:-1] | rows[2:]
+    if not include_centre:
+        # the centre only matters where neither its row nor its column neighbours are set
+        others = padded[:, :-2] | padded[:, 2:]
+        result = rows[:-2] | rows[2:] | others[1:-1]
+    return result
+
+
+def applyDilationNumpy(pixel_array, w, h):
+    import numpy
+
+    return anyNeighbourNonZeroNumpy(pixel_array).astype(numpy.uint8)
+
+
+def applyErosionNumpy(pixel_array, w, h):
+    import numpy
+
+    result_array = numpy.zeros((h, w), dtype=numpy.uint8)
+    if h > 2 and w > 2:
+        nonzero = asNumpyArray(pixel_array) != 0
+        rows = nonzero[:-2] & nonzero[1:-1] & nonzero[2:]
+        result_array[1:-1, 1:-1] = rows[:, :-2] & rows[:, 1:-1] & rows[:, 2:]
+    return result_array
+
+
+def applyClosingNumpy(pixel_array, w, h):
+    # the reference computes the same dilation, and then the same erosion, ten times over; once gives the same result
+    return applyErosionNumpy(applyDilationNumpy(pixel_array, w, h), w, h)
+
+
+# This method labels the 4-connected objects of a binary array and measures them, numbering them in the order
+# their first pixel is met in a row by row scan, like the reference. It works on runs of non zero pixels rather
+# than on single pixels: runs in neighbouring rows that overlap are joined, by hooking roots onto the smallest run
+# index and halving paths until no joined pair of runs has different roots.
+def computeConnectedComponentLabelingWithStatisticsNumpy(pixel_array, w, h):
+    import numpy
+
+    nonzero = asNumpyArray(pixel_array) != 0
+    padded = numpy.zeros((h, w + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = nonzero
+    steps = numpy.diff(padded, axis=1)
+    # runs in scan order, as half open column ranges [start, end) of row run_row
+    run_row, start = numpy.nonzero(steps == 1)
+    end = numpy.nonzero(steps == -1)[1]
+    run_count = len(start)
+
+    # runs in row y - 1 overlap run k of row y from the first one ending after start[k]
+    # up to the last one starting before end[k]; rows keys are y * (w + 1) + column
+    row_base = run_row * (w + 1)
+    start_keys = row_base + start
+    end_keys = row_base + end
+    first = numpy.searchsorted(end_keys, start_keys - (w + 1), side='right')
+    last = numpy.searchsorted(start_keys, end_keys - (w + 1), side='left')
+    overlaps = numpy.maximum(last - first, 0)
+    upper = numpy.repeat(numpy.arange(run_count), overlaps)
+    lower = numpy.arange(len(upper)) - numpy.repeat(numpy.cumsum(overlaps) - overlaps - first, overlaps)
+
+    parent = numpy.arange(run_count)
+    while True:
+        roots_upper = parent[upper]
+        roots_lower = parent[lower]
+        unjoined = roots_upper != roots_lower
+        if not unjoined.any():
+            break
+        high = numpy.maximum(roots_upper[unjoined], roots_lower[unjoined])
+        low = numpy.minimum(roots_upper[unjoined], roots_lower[unjoined])
+        numpy.minimum.at(parent, high, low)
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+    # each root is the first run of its object in scan order, so numbering the roots in order numbers the objects
+    roots, run_label = numpy.unique(parent, return_inverse=True)
+    run_label = run_label.astype(numpy.int32) + 1
+    flat = numpy.zeros(h * w + 1, dtype=numpy.int32)
+    flat_start = run_row * w + start
+    numpy.add.at(flat, flat_start, run_label)
+    numpy.add.at(flat, flat_start + (end - start), -run_label)
+    result_array = numpy.cumsum(flat[:-1], dtype=numpy.int32).reshape(h, w)
+
+    # a run has 2 + 2 * length sides, less two for every pixel it shares with a run above or below
+    count = len(roots) + 1
+    length = end - start
+    area = numpy.bincount(run_label, weights=length, minlength=count)
+    sum_x = numpy.bincount(run_label, weights=(start + end - 1) * length / 2, minlength=count)
+    sum_y = numpy.bincount(run_label, weights=run_row * length, minlength=count)
+    shared = numpy.minimum(end[upper], end[lower]) - numpy.maximum(start[upper], start[lower])
+    perimeter = (numpy.bincount(run_label, weights=2 + 2 * length, minlength=count)
+                 - numpy.bincount(run_label[upper], weights=2 * shared, minlength=count))
+    min_w = numpy.full(count, w)
+    min_h = numpy.full(count, h)
+    max_w = numpy.zeros(count, dtype=int)
+    max_h = numpy.zeros(count, dtype=int)
+    numpy.minimum.at(min_w, run_label, start)
+    numpy.minimum.at(min_h, run_label, run_row)
+    numpy.maximum.at(max_w, run_label, end - 1)
+    numpy.maximum.at(max_h, run_label, run_row)
+
+    statistics = {}
+    for key in range(1, count):
+        statistics[key] = {'area': int(area[key]),
+                           'bounding_box': (int(min_w[key]), int(min_h[key]), int(max_w[key]), int(max_h[key])),
+                           'perimeter': int(perimeter[key]),
+                           'centroid': (float(sum_x[key] / area[key]), float(sum_y[key] / area[key]))}
+    return (result_array, statistics)
+
+
+def computeConnectedComponentLabelingNumpy(pixel_array, w, h):
+    (result_array, statistics) = computeConnectedComponentLabelingWithStatisticsNumpy(pixel_array, w, h)
+    result_dict = {key: statistics[key]['area'] for key in statistics}
+    return (result_array, result_dict)
+
+
+def computeVortexesNumpy(pixel_array, w, h):
+    import numpy
+
+    ones = asNumpyArray(pixel_array) == 1
+    rows = numpy.nonzero(ones.any(axis=1))[0]
+    columns = numpy.nonzero(ones.any(axis=0))[0]
+    if len(rows) == 0:
+        return (w, h, 0, 0)
+    return (int(columns[0]), int(rows[0]), int(columns[-1]), int(rows[-1]))
+
+
+def computeMainObjectNumpy(pixel_array, array_dict, w, h):
+    import numpy
+
+    max = 0
+    num = 0
+    for key in array_dict:
+        if array_dict[key] > max:
+            max = array_dict[key]
+            num = key
+    return (asNumpyArray(pixel_array) == num).astype(numpy.uint8)
+
+
+def computeMainObjectEdgeNumpy(pixel_array, w, h):
+    import numpy
+
+    pixel_array = asNumpyArray(pixel_array)
+    return numpy.where(anyNeighbourNonZeroNumpy(pixel_array, include_centre=False), 1 - pixel_array.astype(numpy.int32), 0)
+
+
+def computeMainObjectOutlineNumpy(label_array, statistics, w, h):
+    import numpy
+
+    num = 0
+    largest = 0
+    for key in statistics:
+        if statistics[key]['area'] > largest:
+            largest = statistics[key]['area']
+            num = key
+    if num == 0:
+        return ((w, h, 0, 0), [], numpy.ones((h, w), dtype=numpy.uint8), (0, 0, w - 1, h - 1))
+
+    (min_w, min_h, max_w, max_h) = statistics[num]['bounding_box']
+    (x0, y0, x1, y1) = crop_box = (max(min_w - 1, 0), max(min_h - 1, 0), min(max_w + 1, w - 1), min(max_h + 1, h - 1))
+    mask_crop = (asNumpyArray(label_array)[y0:y1 + 1, x0:x1 + 1] == num).astype(numpy.uint8)
+    contour = anyNeighbourNonZeroNumpy(mask_crop, include_centre=False) & (mask_crop == 0)
+    ys, xs = numpy.nonzero(contour)
+    contour_points = list(zip((xs + x0).tolist(), (ys + y0).tolist()))
+    if not contour_points:
+        return ((w, h, 0, 0), contour_points, mask_crop, crop_box)
+    bounding_box = (int(xs.min()) + x0, int(ys[0]) + y0, int(xs.max()) + x0, int(ys[-1]) + y0)
+    return (bounding_box, contour_points, mask_crop, crop_box)
+
+
+# The implementations of the stages of the pipeline, by backend; see computeQRCodeBoundingBox
+stage_backends = {
+    'python': {
+        'getGreyscalePixelArrayfromPixelArray': getGreyscalePixelArrayfromPixelArray,
+        'getHorizontalEdges': getHorizontalEdges,
+        'getVerticalEdges': getVerticalEdges,
+        'getGradientMagnitude': getGradientMagnitude,
+        'applyGaussianSmooth': applyGaussianSmooth,
+        'applyBoxSmooth': applyBoxSmooth,
+        'applyThresholdingOperation': applyThresholdingOperation,
+        'applyDilation': applyDilation,
+        'applyErosion': applyErosion,
+        'applyClosing': applyClosing,
+        'computeConnectedComponentLabeling': computeConnectedComponentLabeling,
+        'computeConnectedComponentLabelingWithStatistics': computeConnectedComponentLabelingWithStatistics,
+        'computeMainObject': computeMainObject,
+        'computeMainObjectEdge': computeMainObjectEdge,
+        'computeVortexes': computeVortexes,
+        'computeMainObjectOutline': computeMainObjectOutline,
+    },
+    'numpy': {
+        'getGreyscalePixelArrayfromPixelArray': getGreyscalePixelArrayfromPixelArrayNumpy,
+        'getHorizontalEdges': getHorizontalEdgesNumpy,
+        'getVerticalEdges': getVerticalEdgesNumpy,
+        'getGradientMagnitude': getGradientMagnitudeNumpy,
+        'applyGaussianSmooth': applyGaussianSmoothNumpy,
+        'applyBoxSmooth': applyBoxSmoothNumpy,
+        'applyThresholdingOperation': applyThresholdingOperationNumpy,
+        'applyDilation': applyDilationNumpy,
+        'applyErosion': applyErosionNumpy,
+        'applyClosing': applyClosingNumpy,
+        'computeConnectedComponentLabeling': computeConnectedComponentLabelingNumpy,
+        'computeConnectedComponentLabelingWithStatistics': computeConnectedComponentLabelingWithStatisticsNumpy,
+        'computeMainObject': computeMainObjectNumpy,
+        'computeMainObjectEdge': computeMainObjectEdgeNumpy,
+        'computeVortexes': computeVortexesNumpy,
+        'computeMainObjectOutline': computeMainObjectOutlineNumpy,
+    },
+}
+
+
+# This method returns the backend used when none is given: numpy if it is installed, otherwise python
+def defaultBackend():
+    try:
+        import numpy
+    except ImportError:
+        return 'python'
+    del numpy
+    return 'numpy'
+
+
+# This method runs the detection stages on a greyscale image and returns the bounding box of the QR code,
+# as (min_w, min_h, max_w, max_h); backend is a key of stage_backends
+def computeQRCodeBoundingBox(image_width, image_height, greyscale_array, backend=None):
+    if backend is None:
+        backend = defaultBackend()
+    if backend not in stage_backends:
+        raise ValueError("backend must be one of {}".format(", ".join(sorted(stage_backends))))
+    stages = stage_backends[backend]
+
+    horizontal_edge = stages['getHorizontalEdges'](image_width, image_height, greyscale_array)
+    vertical_edge = stages['getVerticalEdges'](image_width, image_height, greyscale_array)
+    gradient_magnitude = stages['getGradientMagnitude'](image_width, image_height, horizontal_edge, vertical_edge)
+    # one box filter cascade blurs about as much as applyGaussianSmooth applied eleven times
+    gaussian_smooth = stages['applyBoxSmooth'](image_width, image_height, gradient_magnitude, 11)
+    thresholding_operation = stages['applyThresholdingOperation'](image_width, image_height, gaussian_smooth)
+    closing_array = stages['applyClosing'](thresholding_operation, image_width, image_height)
+    (connected_array, statistics) = stages['computeConnectedComponentLabelingWithStatistics'](
+        closing_array, image_width, image_height)
+    (bounding_box, contour_points, mask_crop, crop_box) = stages['computeMainObjectOutline'](
+        connected_array, statistics, image_width, image_height)
+    return bounding_box
+
+
+
+# the directory main keeps decoded images in
+CACHE_DIRECTORY = "./.imagecache"
+
+
 def main():
     filename = "./images/covid19QRCode/challenging/shanghai.png"
 
-    # we read in the png file, and receive three pixel arrays for red, green and blue components, respectively
-    # each pixel array contains 8 bit integer values between 0 and 255 encoding the color values
-    (image_width, image_height, px_array_r, px_array_g, px_array_b) = readRGBImageToSeparatePixelArrays(filename)
+    # we read in the png file once, and receive its rows of RGB triplets to show, as well as a greyscale image to
+    # detect the QR code in; the values are 8 bit integers between 0 and 255
+    # the decoded rows are kept in a cache directory, so running again on the same image does not decode it again
+    cache = imageIO.cache.DecodeCache(CACHE_DIRECTORY)
+    (image_width, image_height, rgb_rows, greyscale_array) = readRGBImageToRowsAndGreyImage(filename, cache)
 
-    pyplot.imshow(prepareRGBImageForImshowFromIndividualArrays(px_array_r, px_array_g, px_array_b, image_width, image_height))
+    pyplot.imshow(prepareRGBImageForImshowFromRows(rgb_rows, image_width, image_height))
 
-    greyscale_array = getGreyscalePixelArrayfromPixelArray(image_width, image_height, px_array_r, px_array_g, px_array_r)
     #writeGreyscalePixelArraytoPNG("poster1smallrotated.png", greyscale_array, image_width, image_height)
-    horizontal_edge = getHorizontalEdges(image_width,image_height,greyscale_array)
-    vertical_edge = getVerticalEdges(image_width, image_height, greyscale_array)
-    gradient_magnitude = getGradientMagnitude(image_width,image_height,horizontal_edge,vertical_edge)
-    gaussian_smooth = applyGaussianSmooth(image_width,image_height,gradient_magnitude)
-    for i in range(10):
-        gaussian_smooth = applyGaussianSmooth(image_width,image_height, gaussian_smooth)
-    thresholding_operation = applyThresholdingOperation(image_width,image_height,gaussian_smooth)
-    closing_array = applyClosing(thresholding_operation, image_width, image_height)
-    (connected_array, array_dict) = computeConnectedComponentLabeling(closing_array, image_width, image_height)
-    main_object = computeMainObject(connected_array,array_dict,image_width,image_height)
-    main_object_edge = computeMainObjectEdge(main_object, image_width, image_height)
-    (min_w, min_h, max_w, max_h) = computeVortexes(main_object_edge, image_width, image_height)
+    (min_w, min_h, max_w, max_h) = computeQRCodeBoundingBox(image_width, image_height, greyscale_array)
     #pyplot.imshow(main_object_edge, cmap='gray')
 
 
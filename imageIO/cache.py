@@ -0,0 +1,205 @@
+"""
+A cache of decoded PNG images.
+
+Decoding a PNG file again and again
+(when the same images are processed on every run)
+is wasted work.
+A :class:`DecodeCache` keeps the decoded pixel values of each image
+in a directory on disk,
+keyed by a hash of the file's contents,
+and keeps the most recently used ones in memory too.
+
+    cache = DecodeCache('.imagecache')
+    width, height, rows, info = cache.read('poster.png')
+
+The rows and info are as from :meth:`png.Reader.read`,
+except that each row is a ``memoryview``.
+Another way of decoding can be cached instead,
+by naming the :class:`png.Reader` method to decode with:
+
+    width, height, rows, info = cache.read('poster.png', 'asRGB8')
+
+A file whose path, size, and modification time are unchanged since
+it was last read is not hashed again;
+any other file is hashed, so a copy or a renamed file is still found.
+Pixel values are stored uncompressed and memory mapped when read,
+so a hit costs neither a decode nor a copy.
+"""
+
+import ast
+import collections
+import hashlib
+import json
+import os
+import tempfile
+from array import array
+
+from . import png
+
+
+# The png.Reader methods that DecodeCache.read can decode with.
+DECODE_METHODS = ('read', 'asDirect', 'asRGB8', 'asRGBA8', 'asGreyscale8')
+
+
+class DecodeCache:
+    """
+    A cache of decoded PNG images, stored in `directory`
+    (which is created if need be).
+    The most recently read images are also kept in memory,
+    up to a total of `budget` bytes of pixel values.
+    """
+
+    def __init__(self, directory, budget=2 ** 28):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(directory, exist_ok=True)
+        # Maps content hash to (width, height, values, info),
+        # least recently used first.
+        self.lru = collections.OrderedDict()
+        self.lru_bytes = 0
+        # Maps a file's path to [modification time, size, content hash].
+        # On disk it is a log, one JSON list of
+        # [path, modification time, size, content hash] to a line,
+        # appended to as files are hashed; later lines win.
+        self.index = {}
+        self.index_path = os.path.join(directory, 'index.jsonl')
+        try:
+            with open(self.index_path) as f:
+                for line in f:
+                    try:
+                        name, mtime, size, key = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash.
+                        continue
+                    self.index[name] = [mtime, size, key]
+        except OSError:
+            pass
+
+    def read(self, path, method='read'):
+        """
+        Return the image in the PNG file at `path`,
+        as (*width*, *height*, *rows*, *info*) like
+        :meth:`png.Reader.read`,
+        or like the :class:`png.Reader` method named by `method`
+        (such as ``'asRGB8'``), each of which is cached separately.
+        The file is only decoded if it is not in the cache.
+        """
+
+        if method not in DECODE_METHODS:
+            raise ValueError("method must be one of %s" %
+                             ", ".join(DECODE_METHODS))
+        key = self.key(path)
+        if method != 'read':
+            key = key + '.' + method
+        entry = self.lru.pop(key, None)
+        if entry is None:
+            entry = self.load(key)
+        if entry is None:
+            entry = self.store(key, path, method)
+        else:
+            self.lru_bytes -= entry[2].nbytes
+        self.remember(key, entry)
+
+        width, height, values, info = entry
+        # Values per row
+        vpr = width * info['planes']
+        rows = (values[i: i + vpr] for i in range(0, len(values), vpr))
+        return width, height, rows, dict(info)
+
+    def key(self, path):
+        """
+        The hash of the contents of the file at `path`;
+        taken from the index when the file is unchanged.
+        """
+
+        st = os.stat(path)
+        name = os.path.abspath(path)
+        known = self.index.get(name)
+        if known and known[:2] == [st.st_mtime_ns, st.st_size]:
+            return known[2]
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(block)
+        key = digest.hexdigest()
+        self.index[name] = [st.st_mtime_ns, st.st_size, key]
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps([name, st.st_mtime_ns, st.st_size, key]) + '\n')
+        return key
+
+    def load(self, key):
+        """
+        Load the entry for `key` from the directory,
+        or return ``None`` if it is not there,
+        or its values are not the size its info says they should be
+        (as when the file was cut short).
+        """
+
+        base = os.path.join(self.directory, key)
+        try:
+            with open(base + '.info') as f:
+                info = ast.literal_eval(f.read())
+            mapped = png.map_file(base + '.raw')
+            typecode = info.pop('typecode')
+            width, height = info['size']
+            values = memoryview(mapped).cast(typecode)
+        except (OSError, ValueError, SyntaxError, TypeError, KeyError):
+            return None
+        if len(values) != width * height * info['planes']:
+            return None
+        if 'physical' in info:
+            info['physical'] = png.Resolution(*info['physical'])
+        return width, height, values, info
+
+    def store(self, key, path, method='read'):
+        """
+        Decode the PNG file at `path`
+        with the :class:`png.Reader` method named `method`,
+        and store it as `key`.
+        """
+
+        reader = png.Reader(filename=path)
+        width, height, rows, info = getattr(reader, method)()
+        typecode = 'BH'[info['bitdepth'] > 8]
+        values = array(typecode)
+        for row in rows:
+            if isinstance(row, array):
+                values.extend(row)
+            else:
+                values.frombytes(row)
+
+        stored = dict(info, typecode=typecode)
+        if 'physical' in stored:
+            stored['physical'] = tuple(stored['physical'])
+        base = os.path.join(self.directory, key)
+        self.write_atomically(base + '.raw', values.tobytes())
+        self.write_atomically(base + '.info', repr(stored).encode('utf-8'))
+        return width, height, memoryview(values), info
+
+    def remember(self, key, entry):
+        """
+        Keep `entry` in memory as the most recently used,
+        forgetting the least recently used ones
+        to stay within the budget.
+        """
+
+        self.lru[key] = entry
+        self.lru_bytes += entry[2].nbytes
+        while self.lru_bytes > self.budget and len(self.lru) > 1:
+            _, old = self.lru.popitem(last=False)
+            self.lru_bytes -= old[2].nbytes
+
+    def write_atomically(self, path, data):
+        """
+        Write `data` to the file at `path`,
+        such that a reader never sees it partly written.
+        """
+
+        fd, temporary = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
@@ -174,14 +174,20 @@ from __future__ import print_function
 __version__ = "0.0.20"
 
 import collections
+import concurrent.futures
+import functools
 import io   # For io.BytesIO
 import itertools
 import math
+import mmap
 # http://www.python.org/doc/2.4.4/lib/module-operator.html
 import operator
+import os
+import queue
 import re
 import struct
 import sys
+import threading
 # http://www.python.org/doc/2.4.4/lib/module-warnings.html
 import warnings
 import zlib
@@ -189,13 +195,30 @@ import zlib
 from array import array
 
 
-__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array']
+__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array',
+           'probe', 'probe_many']
 
 
 # The PNG signature.
 # http://www.w3.org/TR/PNG/#5PNG-file-signature
 signature = struct.pack('8B', 137, 80, 78, 71, 13, 10, 26, 10)
 
+# The number of scanlines that are collected, when reading,
+# before their filters are undone together.
+UNFILTER_BATCH_ROWS = 256
+
+# The most bytes that are decompressed at a time
+# when decompressing into a preallocated buffer.
+INFLATE_WINDOW = 2 ** 20
+
+# The size of the blocks of scanline data that are compressed
+# independently when writing with several threads.
+COMPRESS_BLOCK_BYTES = 2 ** 18
+
+# The most items that each stage of a pipelined Reader
+# runs ahead of the next.
+PIPELINE_DEPTH = 4
+
 # The xstart, ystart, xstep, ystep for the Adam7 interlace passes.
 adam7 = ((0, 0, 8, 8),
          (4, 0, 8, 8),
@@ -206,6 +229,36 @@ adam7 = ((0, 0, 8, 8),
          (0, 1, 1, 2))
 
 
+# For a reduction by 1, 2, 4, or 8 in each direction,
+# the number of Adam7 passes that together have every pixel
+# whose x and y coordinates are both multiples of the reduction.
+adam7_reduced_passes = {1: 7, 2: 5, 4: 3, 8: 1}
+
+
+@functools.lru_cache(maxsize=32)
+def adam7_geometry(width, height):
+    """
+    The geometry of the reduced pass images of an Adam7 interlaced image
+    of size `width` by `height` pixels.
+
+    Returns a tuple with a
+    (*xstart*, *ystart*, *xstep*, *ystep*, *ppr*, *nrows*, *index*)
+    tuple for each pass that has any pixels, in order;
+    *ppr* and *nrows* are the pixels per row and number of rows
+    of the reduced image,
+    and *index* is the pass's position in :data:`adam7`.
+    """
+
+    geometry = []
+    for index, (xstart, ystart, xstep, ystep) in enumerate(adam7):
+        if xstart >= width or ystart >= height:
+            continue
+        ppr = (width - xstart + xstep - 1) // xstep
+        nrows = (height - ystart + ystep - 1) // ystep
+        geometry.append((xstart, ystart, xstep, ystep, ppr, nrows, index))
+    return tuple(geometry)
+
+
 def adam7_generate(width, height):
     """
     Generate the coordinates for the reduced scanlines
@@ -224,6 +277,10 @@ def adam7_generate(width, height):
         yield ((xstart, y, xstep) for y in range(ystart, height, ystep))
 
 
+# The result of :func:`probe`.
+Probe = collections.namedtuple(
+    'Probe', 'width height bitdepth color_type interlace chunks')
+
 # Models the 'pHYs' chunk (used by the Reader)
 Resolution = collections.namedtuple('_Resolution', 'x y unit_is_meter')
 
@@ -347,6 +404,13 @@ class ChunkError(FormatError):
     pass
 
 
+class MemoryBudgetError(Error):
+    """
+    Decoding the image would need more memory than
+    the budget given to the :class:`Reader`.
+    """
+
+
 class Default:
     """The default for the greyscale paramter."""
 
@@ -373,7 +437,9 @@ class Writer:
                  chunk_limit=2**20,
                  x_pixels_per_unit=None,
                  y_pixels_per_unit=None,
-                 unit_is_meter=False):
+                 unit_is_meter=False,
+                 filter_type=0,
+                 threads=None):
         """
         Create a PNG encoder object.
 
@@ -414,6 +480,13 @@ class Writer:
         unit_is_meter
           `True` to indicate that the unit (for the `pHYs`
           chunk) is metre.
+        filter_type
+          Scanline filter: 0 (none) to 4 (Paeth),
+          or ``'sum'`` to choose one for each scanline;
+          default: 0.
+        threads
+          Number of threads used to compress the image;
+          default: None (compress on the calling thread).
 
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
@@ -522,6 +595,25 @@ class Writer:
         compressing the image.
         In order to avoid using large amounts of memory,
         multiple ``IDAT`` chunks may be created.
+
+        `filter_type` selects the filter applied to each scanline
+        before compression
+        (see http://www.w3.org/TR/PNG/#9Filters).
+        A filter usually makes the compressed image smaller,
+        particularly for photographic images and smooth gradients,
+        at the cost of a slower write.
+        An integer from 0 to 4 uses that filter
+        (None, Sub, Up, Average, Paeth) for every scanline;
+        ``'sum'`` tries every filter on each scanline and
+        picks the one with the minimum sum of absolute differences
+        (the heuristic recommended by the PNG specification).
+        The default, 0, leaves the scanlines unfiltered.
+
+        If `threads` is more than 1, the scanline data is split into
+        blocks that are compressed at the same time on a pool of
+        that many threads (see :class:`ParallelCompressor`).
+        This makes writing a large image faster on a multicore machine,
+        for a slightly larger file.
         """
 
         # At the moment the `planes` argument is ignored;
@@ -545,6 +637,11 @@ class Writer:
             raise ProtocolError(
                 "transparent colour not allowed with alpha channel")
 
+        if filter_type not in (0, 1, 2, 3, 4, 'sum'):
+            raise ProtocolError(
+                "filter_type must be 0 to 4 or 'sum', not %r" %
+                (filter_type,))
+
         # bitdepth is either single integer, or tuple of integers.
         # Convert to tuple.
         try:
@@ -610,6 +707,8 @@ class Writer:
         self.x_pixels_per_unit = x_pixels_per_unit
         self.y_pixels_per_unit = y_pixels_per_unit
         self.unit_is_meter = bool(unit_is_meter)
+        self.filter_type = filter_type
+        self.threads = threads
 
         self.color_type = (4 * self.alpha +
                            2 * (not greyscale) +
@@ -723,8 +822,24 @@ class Writer:
 
         self.write_preamble(outfile)
 
+        # Filter unit: bytes per complete pixel, at least 1.
+        fo = max(1, int(math.ceil(self.psize)))
+        # Indexes of the rows that start a reduced pass image;
+        # these are the first row of their own image,
+        # so must not be filtered against the previous row.
+        pass_starts = {0}
+        if self.interlace:
+            n = 0
+            for geometry in adam7_geometry(self.width, self.height):
+                pass_starts.add(n)
+                # Add the number of rows in the pass.
+                n += geometry[5]
+        previous = None
+
         # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
+        if self.threads and self.threads > 1:
+            compressor = ParallelCompressor(self.compression, self.threads)
+        elif self.compression is not None:
             compressor = zlib.compressobj(self.compression)
         else:
             compressor = zlib.compressobj()
@@ -734,15 +849,22 @@ class Writer:
         data = bytearray()
 
         for i, row in enumerate(rows):
-            # Add "None" filter type.
-            # Currently, it's essential that this filter type be used
-            # for every scanline as
-            # we do not mark the first row of a reduced pass image;
-            # that means we could accidentally compute
-            # the wrong filtered scanline if we used
-            # "up", "average", or "paeth" on such a line.
-            data.append(0)
-            data.extend(row)
+            if self.filter_type == 0:
+                data.append(0)
+                data.extend(row)
+            else:
+                row = bytearray(row)
+                if i in pass_starts:
+                    previous = None
+                if self.filter_type == 'sum':
+                    filter_type, filtered = filter_scanline_adaptive(
+                        row, fo, previous)
+                else:
+                    filter_type = self.filter_type
+                    filtered = filter_scanline(filter_type, row, fo, previous)
+                data.append(filter_type)
+                data.extend(filtered)
+                previous = row
             if len(data) > self.chunk_limit:
                 compressed = compressor.compress(data)
                 if len(compressed):
@@ -820,76 +942,169 @@ class Writer:
                    int(self.unit_is_meter))
             write_chunk(outfile, b'pHYs', struct.pack("!LLB", *tup))
 
-    def write_array(self, outfile, pixels):
+    def write_array(self, outfile, pixels, stride=None):
         """
         Write an array that holds all the image values
         as a PNG file on the output file.
         See also :meth:`write` method.
+
+        `pixels` may be any sequence of values, or
+        any object that supports the buffer protocol
+        (``bytearray``, ``memoryview``, ``array.array``, a ``numpy`` array,
+        and so on) whose items are bytes or,
+        for a bit depth over 8, unsigned 16-bit integers.
+        A buffer is not copied:
+        each row is passed on as a ``memoryview`` slice of it.
+
+        `stride` is the number of values from the start of one row
+        to the start of the next;
+        by default it is the number in a row, ``width * planes``,
+        and it can be larger to write rows that are padded
+        or that are part of a wider image.
         """
 
+        # Values per row
+        vpr = self.width * self.planes
+        if stride is None:
+            stride = vpr
+        if stride < vpr:
+            raise ProtocolError(
+                "stride (%d) is less than the values per row (%d)" %
+                (stride, vpr))
+        view = buffer_values(pixels, self.bitdepth)
+        if view is not None:
+            if len(view) < stride * (self.height - 1) + vpr:
+                raise ProtocolError(
+                    "buffer of %d values is too small for %d rows "
+                    "of %d values with stride %d" %
+                    (len(view), self.height, vpr, stride))
+            pixels = view
+
         if self.interlace:
-            if type(pixels) != array:
+            fmt = 'BH'[self.bitdepth > 8]
+            if view is not None or stride != vpr:
+                # Gather into a compact array, a row at a time.
+                a = array(fmt)
+                for row in self.array_scanlines(pixels, stride):
+                    if view is not None:
+                        a.frombytes(row.cast('B'))
+                    else:
+                        a.extend(row)
+                pixels = a
+            elif type(pixels) != array:
                 # Coerce to array type
-                fmt = 'BH'[self.bitdepth > 8]
                 pixels = array(fmt, pixels)
             self.write_passes(outfile, self.array_scanlines_interlace(pixels))
         else:
-            self.write_passes(outfile, self.array_scanlines(pixels))
+            self.write_passes(outfile, self.array_scanlines(pixels, stride))
 
-    def array_scanlines(self, pixels):
+    def array_scanlines(self, pixels, stride=None):
         """
         Generates rows (each a sequence of values) from
         a single array of values.
+        `stride` is the number of values from the start of one row
+        to the start of the next (by default, the values per row).
         """
 
         # Values per row
         vpr = self.width * self.planes
-        stop = 0
+        if stride is None:
+            stride = vpr
         for y in range(self.height):
-            start = stop
-            stop = start + vpr
-            yield pixels[start:stop]
+            start = y * stride
+            yield pixels[start:start + vpr]
 
     def array_scanlines_interlace(self, pixels):
         """
         Generator for interlaced scanlines from an array.
         `pixels` is the full source image as a single array of values.
         The generator yields each scanline of the reduced passes in turn,
-        each scanline being a sequence of values.
+        each scanline being a sequence of values
+        (a ``memoryview`` of the source, or of its reduced pass image).
         """
 
         # http://www.w3.org/TR/PNG/#8InterlaceMethods
         # Array type.
         fmt = 'BH'[self.bitdepth > 8]
+        planes = self.planes
         # Value per row
-        vpr = self.width * self.planes
+        vpr = self.width * planes
+        source = memoryview(pixels)
+
+        for xstart, ystart, xstep, ystep, ppr, nrows, index in \
+                adam7_geometry(self.width, self.height):
+            # The pass is a lattice in the source: from `offset`,
+            # `skip` apart along a row and `stride` apart down a column.
+            offset = ystart * vpr + xstart * planes
+            skip = planes * xstep
+            stride = vpr * ystep
+            if xstep == 1:
+                # Easy case: each line is a simple slice.
+                for k in range(nrows):
+                    o = offset + k * stride
+                    yield source[o: o + vpr]
+                continue
+            # Values per row (of reduced image)
+            pvpr = ppr * planes
+            # The whole reduced image is gathered at once,
+            # with slice assignments a row or a column at a time,
+            # whichever takes fewer of them.
+            reduced = array(fmt, bytes(array(fmt).itemsize * nrows * pvpr))
+            if nrows <= ppr:
+                for k in range(nrows):
+                    o = offset + k * stride
+                    for i in range(planes):
+                        reduced[k * pvpr + i: (k + 1) * pvpr: planes] = \
+                            pixels[o + i: o + (ppr - 1) * skip + i + 1: skip]
+            else:
+                column_end = (nrows - 1) * stride + 1
+                for j in range(ppr):
+                    for i in range(planes):
+                        o = offset + j * skip + i
+                        reduced[j * planes + i:: pvpr] = \
+                            pixels[o: o + column_end: stride]
+            view = memoryview(reduced)
+            for k in range(nrows):
+                yield view[k * pvpr: (k + 1) * pvpr]
+
+
+def buffer_values(pixels, bitdepth):
+    """
+    Return a flat ``memoryview`` of the values in `pixels`,
+    if it supports the buffer protocol with the unsigned native
+    items used for `bitdepth` (bytes, or 16-bit for a bitdepth over 8),
+    and is C-contiguous.
+    Otherwise return ``None``;
+    signed, floating point, and byte-swapped buffers are among those,
+    as their values cannot be written as they are.
+    """
 
-        # Each iteration generates a scanline starting at (x, y)
-        # and consisting of every xstep pixels.
-        for lines in adam7_generate(self.width, self.height):
-            for x, y, xstep in lines:
-                # Pixels per row (of reduced image)
-                ppr = int(math.ceil((self.width - x) / float(xstep)))
-                # Values per row (of reduced image)
-                reduced_row_len = ppr * self.planes
-                if xstep == 1:
-                    # Easy case: line is a simple slice.
-                    offset = y * vpr
-                    yield pixels[offset: offset + vpr]
-                    continue
-                # We have to step by xstep,
-                # which we can do one plane at a time
-                # using the step in Python slices.
-                row = array(fmt)
-                # There's no easier way to set the length of an array
-                row.extend(pixels[0:reduced_row_len])
-                offset = y * vpr + x * self.planes
-                end_offset = (y + 1) * vpr
-                skip = self.planes * xstep
-                for i in range(self.planes):
-                    row[i::self.planes] = \
-                        pixels[offset + i: end_offset: skip]
-                yield row
+    try:
+        view = memoryview(pixels)
+    except TypeError:
+        return None
+    fmt = 'BH'[bitdepth > 8]
+    native = {'@', '='} | {'<' if sys.byteorder == 'little' else '>'}
+    if (not view.c_contiguous or
+            view.format.lstrip('@=<>!') != fmt or
+            view.format[:-1] not in native | {''} or
+            view.itemsize != array(fmt).itemsize):
+        return None
+    return view.cast('B').cast(fmt)
+
+
+def equal_mask(values, v):
+    """
+    Return ``bytes`` with a 1 for each of `values` that equals `v`,
+    and a 0 for each that does not.
+    """
+
+    if isinstance(values, (bytes, bytearray)):
+        table = bytearray(256)
+        if v < 256:
+            table[v] = 1
+        return values.translate(table)
+    return bytes(map(v.__eq__, values))
 
 
 def write_chunk(outfile, tag, data=b''):
@@ -917,6 +1132,99 @@ def write_chunks(out, chunks):
         write_chunk(out, *chunk)
 
 
+class ParallelCompressor:
+    """
+    Like the object returned by ``zlib.compressobj``,
+    but the data is compressed on a pool of threads
+    (``zlib`` releases the GIL while it compresses).
+
+    The data is cut into blocks of :data:`COMPRESS_BLOCK_BYTES`,
+    and each block is compressed by its own raw deflate stream,
+    primed with the last 32 KiB of the previous block as
+    a preset dictionary so that matches can still reach back
+    across the boundary.
+    Every block but the last ends with a full flush,
+    so the blocks join into one valid deflate stream;
+    the ``zlib`` header and Adler-32 checksum are added around it.
+    Compressed output is returned by :meth:`compress` and
+    :meth:`flush` in order, as each block becomes ready.
+    """
+
+    def __init__(self, level=None, threads=2):
+        if level is None:
+            level = -1
+        self.level = level
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        # Compressions that have not yet been returned,
+        # and the most there may be.
+        self.pending = collections.deque()
+        self.limit = 2 * threads
+        self.dictionary = b''
+        self.adler = 1
+        self.pending_data = bytearray()
+
+        # http://www.w3.org/TR/PNG/#10CompressionFCHECK
+        # The compression level field is informative only;
+        # it matches the value zlib would write.
+        if level < 0:
+            flevel = 2
+        else:
+            flevel = (0, 0, 1, 1, 1, 1, 2, 3, 3, 3)[level]
+        cmf = 0x78
+        flg = flevel << 6
+        flg += 31 - (cmf * 256 + flg) % 31
+        self.header = bytes([cmf, flg])
+
+    def _compress_block(self, block, dictionary, mode):
+        if dictionary:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -15,
+                                 zdict=dictionary)
+        else:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return c.compress(block) + c.flush(mode)
+
+    def _submit(self, block, mode):
+        self.adler = zlib.adler32(block, self.adler)
+        self.pending.append(self.executor.submit(
+            self._compress_block, block, self.dictionary, mode))
+        self.dictionary = bytes(block[-32768:])
+
+    def _collect(self, wait=False):
+        """
+        Return the compressed output that is ready, in order.
+        When `wait` is true, wait for all the compressions.
+        """
+
+        out = [self.header]
+        self.header = b''
+        while self.pending and (
+                wait or len(self.pending) > self.limit or
+                self.pending[0].done()):
+            out.append(self.pending.popleft().result())
+        return b''.join(out)
+
+    def compress(self, data):
+        self.pending_data.extend(data)
+        view = memoryview(self.pending_data)
+        start = 0
+        # The last block is held back (even when full),
+        # so that flush has one to finish the stream with.
+        while len(view) - start > COMPRESS_BLOCK_BYTES:
+            self._submit(bytes(view[start: start + COMPRESS_BLOCK_BYTES]),
+                         zlib.Z_FULL_FLUSH)
+            start += COMPRESS_BLOCK_BYTES
+        view.release()
+        del self.pending_data[:start]
+        return self._collect()
+
+    def flush(self):
+        self._submit(bytes(self.pending_data), zlib.Z_FINISH)
+        self.pending_data = bytearray()
+        out = self._collect(wait=True)
+        self.executor.shutdown()
+        return out + struct.pack('!L', self.adler & 0xffffffff)
+
+
 def rescale_rows(rows, rescale):
     """
     Take each row in rows (an iterator) and yield
@@ -961,27 +1269,53 @@ def pack_rows(rows, bitdepth):
     # samples per byte
     spb = int(8 / bitdepth)
 
-    def make_byte(block):
-        """Take a block of (2, 4, or 8) values,
-        and pack them into a single byte.
-        """
-
-        res = 0
-        for v in block:
-            res = (res << bitdepth) + v
-        return res
+    tables = pack_tables(bitdepth)
 
     for row in rows:
         a = bytearray(row)
         # Adding padding bytes so we can group into a whole
         # number of spb-tuples.
-        n = float(len(a))
-        extra = math.ceil(n / spb) * spb - n
-        a.extend([0] * int(extra))
+        a.extend(bytes(-len(a) % spb))
         # Pack into bytes.
-        # Each block is the samples for one byte.
-        blocks = group(a, spb)
-        yield bytearray(make_byte(block) for block in blocks)
+        # Each table moves every k-th sample to its place in the byte;
+        # the bytes are combined as one big integer,
+        # which has no carries since their bits are disjoint.
+        packed = 0
+        for k, table in enumerate(tables):
+            packed |= int.from_bytes(a[k::spb].translate(table), 'big')
+        yield bytearray(packed.to_bytes(len(a) // spb, 'big'))
+
+
+@functools.lru_cache()
+def pack_tables(bitdepth):
+    """
+    Tables for packing samples of `bitdepth` (1, 2, or 4) bits,
+    ``8 // bitdepth`` to a byte, most significant first.
+    The k-th table maps each sample value to the byte that has it
+    in the k-th position and zeros elsewhere
+    (for use with ``bytes.translate``).
+    """
+
+    spb = 8 // bitdepth
+    mask = 2 ** bitdepth - 1
+    return [bytes((v & mask) << (bitdepth * (spb - 1 - k))
+                  for v in range(256))
+            for k in range(spb)]
+
+
+@functools.lru_cache()
+def unpack_table(bitdepth):
+    """
+    A table for unpacking samples of `bitdepth` (1, 2, or 4) bits:
+    for each of the 256 possible bytes,
+    the ``8 // bitdepth`` samples packed in it as ``bytes``.
+    The inverse of :func:`pack_tables`.
+    """
+
+    spb = 8 // bitdepth
+    mask = 2 ** bitdepth - 1
+    shifts = [bitdepth * i for i in reversed(range(spb))]
+    return [bytes(mask & (o >> i) for i in shifts) for o in range(256)]
 
 
 def unpack_rows(rows):
@@ -989,8 +1323,28 @@ def unpack_rows(rows):
     to being a sequence of bytes.
     """
     for row in rows:
-        fmt = '!%dH' % len(row)
-        yield bytearray(struct.pack(fmt, *row))
+        view = buffer_values(row, 16)
+        if view is not None:
+            a = array('H')
+            a.frombytes(view.cast('B'))
+        else:
+            a = array('H', row)
+        # PNG is big-endian.
+        if sys.byteorder == 'little':
+            a.byteswap()
+        yield bytearray(a.tobytes())
+
+
+@functools.lru_cache()
+def rescale_table(bitdepth, targetbitdepth=8):
+    """
+    A table, as ``bytes``, mapping each value of `bitdepth` bits
+    to the nearest value of `targetbitdepth` (at most 8) bits
+    on the same scale.
+    """
+
+    factor = float(2 ** targetbitdepth - 1) / float(2 ** bitdepth - 1)
+    return bytes(int(round(x * factor)) for x in range(2 ** bitdepth))
 
 
 def make_palette_chunks(palette):
@@ -1148,6 +1502,18 @@ def from_array(a, mode=None, info={}):
     For example, if the *info* dictionary has a ``greyscale`` key then
     this must be true when mode is ``'L'`` or ``'LA'`` and
     false when mode is ``'RGB'`` or ``'RGBA'``.
+
+    A C-contiguous buffer of unsigned bytes or 16-bit values
+    (or booleans, for a bit depth of 1),
+    such as a ``numpy`` array of shape
+    ``(height, width*channels)`` or ``(height, width, channels)``,
+    is not inspected row by row:
+    its shape gives the size,
+    and the :class:`Image` keeps a flat ``memoryview`` of it,
+    whose rows are written without being copied or checked
+    (see :meth:`Writer.write_array`).
+    A 1-dimensional buffer can be used this way when
+    *info* gives the width and height.
     """
 
     # We abuse the *info* parameter by modifying it.  Take a copy here.
@@ -1206,6 +1572,10 @@ def from_array(a, mode=None, info={}):
         if info['planes'] != planes:
             raise Error("info['planes'] should match mode.")
 
+    flat = flat_buffer(a, planes, info)
+    if flat is not None:
+        return Image(flat, info)
+
     # In order to work out whether we the array is 2D or 3D we need its
     # first row, which requires that we take a copy of its iterator.
     # We may also need the first row to derive width and bitdepth.
@@ -1245,6 +1615,55 @@ def from_array(a, mode=None, info={}):
     return Image(a, info)
 
 
+def flat_buffer(a, planes, info):
+    """
+    Helper for :func:`from_array`.
+    If `a` is a C-contiguous buffer whose shape and item size
+    give the image's size and bit depth (consistent with `info`),
+    fill in any of those missing from `info` and
+    return a flat ``memoryview`` of the values.
+    Otherwise return ``None``.
+    """
+
+    try:
+        view = memoryview(a)
+    except TypeError:
+        return None
+    if not view.c_contiguous or view.format not in ('B', 'H', '?'):
+        return None
+
+    if view.ndim == 1:
+        width, height = info.get('width'), info.get('height')
+        if not width or not height:
+            return None
+    elif view.ndim == 2:
+        height, vpr = view.shape
+        width = vpr // planes
+        if width * planes != vpr:
+            return None
+    elif view.ndim == 3 and view.shape[2] == planes:
+        height, width = view.shape[:2]
+    else:
+        return None
+    if (info.get('width', width) != width or
+            info.get('height', height) != height or
+            view.nbytes != width * height * planes * view.itemsize):
+        return None
+
+    if view.format == '?':
+        bitdepth = 1
+    else:
+        bitdepth = 8 * view.itemsize
+    bitdepth = info.get('bitdepth', bitdepth)
+    if (bitdepth > 8) != (view.itemsize == 2):
+        return None
+
+    info['width'] = width
+    info['height'] = height
+    info['bitdepth'] = bitdepth
+    return view.cast('B').cast('BH'[bitdepth > 8])
+
+
 # So that refugee's from PIL feel more at home.  Not documented.
 fromarray = from_array
 
@@ -1276,10 +1695,8 @@ class Image:
         cannot be streamed again.
         """
 
-        w = Writer(**self.info)
-
         with open(file, 'wb') as fd:
-            w.write(fd, self.rows)
+            self.write(fd)
 
     def write(self, file):
         """Write the image to the open file object.
@@ -1293,7 +1710,11 @@ class Image:
         """
 
         w = Writer(**self.info)
-        w.write(file, self.rows)
+        if isinstance(self.rows, memoryview):
+            # A flat buffer of values, from :func:`flat_buffer`.
+            w.write_array(file, self.rows)
+        else:
+            w.write(file, self.rows)
 
 
 class Reader:
@@ -1301,7 +1722,9 @@ class Reader:
     Pure Python PNG decoder in pure Python.
     """
 
-    def __init__(self, _guess=None, filename=None, file=None, bytes=None):
+    def __init__(self, _guess=None, filename=None, file=None, bytes=None,
+                 unfilter=None, memory_map=False, pipeline=False,
+                 memory_budget=None, downscale=False):
         """
         The constructor expects exactly one keyword argument.
         If you supply a positional argument instead,
@@ -1315,6 +1738,46 @@ class Reader:
         bytes
           ``bytes`` or ``bytearray`` with PNG data.
 
+        The optional `unfilter` argument selects how scanline
+        filters are undone; it is a key of :data:`unfilter_engines`:
+        ``'python'`` (the reference per-byte loops) or
+        ``'numpy'`` (batched array operations).
+        The default is ``'numpy'`` when ``numpy`` can be imported,
+        ``'python'`` otherwise.
+
+        If `memory_map` is true then a `filename` is memory mapped
+        rather than read, and `bytes` is used in place
+        (rather than being copied into a ``BytesIO``).
+        In this mode the data returned by :meth:`chunk` is
+        a ``memoryview`` of the mapping,
+        so ``IDAT`` chunks go to ``zlib`` without being copied.
+
+        If `pipeline` is true then, when the image data is read,
+        the chunks are read from the input and their checksums verified
+        on one worker thread,
+        and the ``IDAT`` data is decompressed on another,
+        each running a few chunks ahead of the next stage
+        (see :func:`run_ahead`);
+        the filters are undone on the calling thread.
+        File reads, CRC checks, and ``zlib`` all release the GIL,
+        so on a large image this overlaps them with the unfiltering.
+        The input must not be used by anything else
+        while the image data is being read.
+
+        `memory_budget`, if given, is the most memory in bytes
+        that decoding the image may take, as estimated by
+        :meth:`memory_needed` from the ``IHDR`` chunk alone,
+        before any image data is decompressed.
+        An image over the budget raises :class:`MemoryBudgetError`,
+        unless `downscale` is true:
+        then :meth:`read` (and so :meth:`asDirect` and friends)
+        returns the image reduced by the least of 2, 4, or 8
+        that fits in the budget, as :meth:`read_reduced` does.
+        Whatever the budget, the decompressed ``IDAT`` data is
+        never allowed to grow past the size that
+        the ``IHDR`` chunk implies
+        (a :class:`FormatError` is raised),
+        so a small file cannot inflate without limit.
         """
         keywords_supplied = (
             (_guess is not None) +
@@ -1324,6 +1787,17 @@ class Reader:
         if keywords_supplied != 1:
             raise TypeError("Reader() takes exactly 1 argument")
 
+        if unfilter is None:
+            unfilter = default_unfilter_engine()
+        if unfilter not in unfilter_engines:
+            raise ProtocolError(
+                "unfilter must be one of %s" %
+                ", ".join(sorted(unfilter_engines)))
+        self.unfilter = unfilter
+        self.pipeline = bool(pipeline)
+        self.memory_budget = memory_budget
+        self.downscale = bool(downscale)
+
         # Will be the first 8 bytes, later on.  See validate_signature.
         self.signature = None
         self.transparent = None
@@ -1332,6 +1806,9 @@ class Reader:
         # past the 4 bytes that specify the chunk type).
         # See preamble method for how this is used.
         self.atchunk = None
+        # List of (type, offset, length) for every chunk,
+        # made by chunk_offsets.
+        self._chunk_offsets = None
 
         if _guess is not None:
             if isarray(_guess):
@@ -1342,9 +1819,15 @@ class Reader:
                 file = _guess
 
         if bytes is not None:
-            self.file = io.BytesIO(bytes)
+            if memory_map:
+                self.file = BufferFile(bytes)
+            else:
+                self.file = io.BytesIO(bytes)
         elif filename is not None:
-            self.file = open(filename, "rb")
+            if memory_map:
+                self.file = BufferFile(map_file(filename))
+            else:
+                self.file = open(filename, "rb")
         elif file is not None:
             self.file = file
         else:
@@ -1405,6 +1888,45 @@ class Reader:
             if t == b'IEND':
                 break
 
+    def chunk_offsets(self):
+        """
+        Return a list of (*type*, *offset*, *length*) triples,
+        one for each chunk in the file, in file order.
+        *offset* is the position of the chunk's data
+        from the start of the file, *length* is the length of the data.
+
+        Only the chunk headers are read, the data is skipped over;
+        the list is made once and kept.
+        The input must be seekable (it always is when memory mapped);
+        the current position is restored afterwards.
+        """
+
+        if self._chunk_offsets is not None:
+            return self._chunk_offsets
+
+        here = self.file.tell()
+        self.file.seek(0)
+        if self.file.read(8) != signature:
+            self.file.seek(here)
+            raise FormatError("PNG file has invalid signature.")
+        offsets = []
+        try:
+            while True:
+                length_type = self._chunk_len_type()
+                if length_type is None:
+                    break
+                length, type = length_type
+                offset = self.file.tell()
+                offsets.append((type, offset, length))
+                if type == b'IEND':
+                    break
+                # Skip the data and its checksum.
+                self.file.seek(offset + length + 4)
+        finally:
+            self.file.seek(here)
+        self._chunk_offsets = offsets
+        return offsets
+
     def undo_filter(self, filter_type, scanline, previous):
         """
         Undo the filter for a scanline.
@@ -1424,92 +1946,128 @@ class Reader:
         the result will be returned as a fresh sequence of bytes.
         """
 
-        # :todo: Would it be better to update scanline in place?
-        result = scanline
-
-        if filter_type == 0:
-            return result
-
-        if filter_type not in (1, 2, 3, 4):
-            raise FormatError(
-                'Invalid PNG Filter Type.  '
-                'See http://www.w3.org/TR/2003/REC-PNG-20031110/#9Filters .')
-
         # Filter unit.  The stride from one pixel to the corresponding
         # byte from the previous pixel.  Normally this is the pixel
         # size in bytes, but when this is smaller than 1, the previous
         # byte is used instead.
         fu = max(1, self.psize)
 
-        # For the first line of a pass, synthesize a dummy previous
-        # line.  An alternative approach would be to observe that on the
-        # first line 'up' is the same as 'null', 'paeth' is the same
-        # as 'sub', with only 'average' requiring any special case.
-        if not previous:
-            previous = bytearray([0] * len(scanline))
-
-        # Call appropriate filter algorithm.  Note that 0 has already
-        # been dealt with.
-        fn = (None,
-              undo_filter_sub,
-              undo_filter_up,
-              undo_filter_average,
-              undo_filter_paeth)[filter_type]
-        fn(fu, scanline, previous, result)
-        return result
-
-    def _deinterlace(self, raw):
+        return undo_filter_scanline(filter_type, fu, scanline, previous)
+
+    def _deinterlace(self, raw, shrink=1):
         """
         Read raw pixel data, undo filters, deinterlace, and flatten.
         Return a single array of values.
+
+        With a `shrink` of 2, 4, or 8 the result is the image reduced
+        by that factor in each direction, made of just the pixels
+        whose coordinates are both multiples of `shrink`.
+        These all come from the early passes,
+        so only those passes need be in `raw`,
+        see :data:`adam7_reduced_passes`.
         """
 
+        planes = self.planes
+        width = (self.width + shrink - 1) // shrink
+        height = (self.height + shrink - 1) // shrink
         # Values per row (of the target image)
-        vpr = self.width * self.planes
+        vpr = width * planes
 
         # Values per image
-        vpi = vpr * self.height
+        vpi = vpr * height
         # Interleaving writes to the output array randomly
         # (well, not quite), so the entire output array must be in memory.
         # Make a result array, and make it big enough.
         if self.bitdepth > 8:
-            a = array('H', [0] * vpi)
+            a = array('H', bytes(2 * vpi))
         else:
-            a = bytearray([0] * vpi)
+            a = bytearray(vpi)
         source_offset = 0
+        engine = unfilter_engines[self.unfilter]
+        fu = max(1, self.psize)
+        bits_per_pixel = self.bitdepth * planes
+        passes = adam7_reduced_passes[shrink]
 
-        for lines in adam7_generate(self.width, self.height):
-            # The previous (reconstructed) scanline.
-            # `None` at the beginning of a pass
-            # to indicate that there is no previous line.
-            recon = None
-            for x, y, xstep in lines:
-                # Pixels per row (reduced pass image)
-                ppr = int(math.ceil((self.width - x) / float(xstep)))
-                # Row size in bytes for this pass.
-                row_size = int(math.ceil(self.psize * ppr))
-
-                filter_type = raw[source_offset]
-                source_offset += 1
-                scanline = raw[source_offset: source_offset + row_size]
-                source_offset += row_size
-                recon = self.undo_filter(filter_type, scanline, recon)
-                # Convert so that there is one element per pixel value
-                flat = self._bytes_to_values(recon, width=ppr)
-                if xstep == 1:
-                    assert x == 0
-                    offset = y * vpr
-                    a[offset: offset + vpr] = flat
-                else:
-                    offset = y * vpr + x * self.planes
-                    end_offset = (y + 1) * vpr
-                    skip = self.planes * xstep
-                    for i in range(self.planes):
-                        a[offset + i: end_offset: skip] = \
-                            flat[i:: self.planes]
+        for xstart, ystart, xstep, ystep, ppr, nrows, index in \
+                adam7_geometry(self.width, self.height):
+            if index >= passes:
+                break
+            # Row size in bytes for this pass.
+            row_size = (ppr * bits_per_pixel + 7) // 8
+            # Each pass is a contiguous run of scanlines,
+            # so the filters of the whole pass are undone at once.
+            engine(raw, source_offset, nrows, row_size, fu)
+            values = self._pass_to_values(
+                raw, source_offset, nrows, row_size, ppr)
+            source_offset += nrows * (row_size + 1)
+
+            # Values per row of the reduced pass image
+            pvpr = ppr * planes
+            # The values of the reduced image go to a lattice
+            # in the target: from `offset`, `skip` apart along a row
+            # and `stride` apart down a column.
+            offset = (ystart // shrink) * vpr + (xstart // shrink) * planes
+            skip = planes * (xstep // shrink)
+            stride = vpr * (ystep // shrink)
+            # The lattice is filled with slice assignments,
+            # either a row or a column at a time,
+            # whichever takes fewer of them.
+            if skip == planes:
+                # Rows are contiguous.
+                by_row = nrows
+            else:
+                by_row = nrows * planes
+            if by_row <= pvpr:
+                for k in range(nrows):
+                    row = values[k * pvpr: (k + 1) * pvpr]
+                    o = offset + k * stride
+                    if skip == planes:
+                        a[o: o + pvpr] = row
+                        continue
+                    for i in range(planes):
+                        a[o + i: o + (ppr - 1) * skip + i + 1: skip] = \
+                            row[i::planes]
+            else:
+                column_end = (nrows - 1) * stride + 1
+                for j in range(ppr):
+                    for i in range(planes):
+                        o = offset + j * skip + i
+                        a[o: o + column_end: stride] = \
+                            values[j * planes + i:: pvpr]
 
         return a
 
+    def _pass_to_values(self, raw, offset, nrows, row_size, ppr):
+        """
+        Convert the `nrows` unfiltered scanlines of `row_size` bytes
+        in `raw` starting at `offset` (each preceded by its filter type)
+        into a single array of values, `ppr` pixels to a row.
+        """
+
+        step = row_size + 1
+        if self.bitdepth == 8:
+            # Every row but the filter type bytes.
+            values = bytearray(nrows * row_size)
+            for i in range(row_size):
+                values[i::row_size] = \
+                    raw[offset + 1 + i: offset + nrows * step: step]
+            return values
+        view = memoryview(raw)
+        if self.bitdepth == 16:
+            values = array('H')
+            for k in range(nrows):
+                start = offset + k * step + 1
+                values.frombytes(view[start: start + row_size])
+            if sys.byteorder == 'little':
+                values.byteswap()
+            return values
+        values = bytearray()
+        for k in range(nrows):
+            start = offset + k * step + 1
+            values.extend(self._bytes_to_values(
+                view[start: start + row_size], width=ppr))
+        return values
+
     def _iter_bytes_to_values(self, byte_rows):
         """
         Iterator that yields each scanline;
@@ -1521,6 +2079,19 @@ class Reader:
         for row in byte_rows:
             yield self._bytes_to_values(row)
 
+    def _iter_straight_values(self, byte_blocks):
+        """
+        Iterator that yields each scanline of a straightlaced image,
+        as a sequence of values,
+        from the decompressed bytes in `byte_blocks`.
+        """
+
+        rows = self._iter_straight_packed(byte_blocks)
+        if self.bitdepth == 8:
+            # The packed rows are already new bytearrays of values.
+            return rows
+        return self._iter_bytes_to_values(rows)
+
     def _bytes_to_values(self, bs, width=None):
         """Convert a packed row of bytes into a row of values.
         Result will be a freshly allocated object,
@@ -1530,50 +2101,105 @@ class Reader:
         if self.bitdepth == 8:
             return bytearray(bs)
         if self.bitdepth == 16:
-            return array('H',
-                         struct.unpack('!%dH' % (len(bs) // 2), bs))
+            values = array('H')
+            values.frombytes(bs)
+            # PNG is big-endian.
+            if sys.byteorder == 'little':
+                values.byteswap()
+            return values
 
         assert self.bitdepth < 8
         if width is None:
             width = self.width
+        table = unpack_table(self.bitdepth)
+        out = bytearray().join(map(table.__getitem__, bs))
+        del out[width:]
+        return out
+
+    def _bytes_to_values_window(self, bs, x0, x1):
+        """Convert the pixels from `x0` up to `x1`
+        of a packed row of bytes into a row of values.
+        The rest of the row is not converted.
+        """
+
+        if self.bitdepth >= 8:
+            # Bytes per pixel
+            bpp = self.planes * self.bitdepth // 8
+            return self._bytes_to_values(bs[x0 * bpp: x1 * bpp])
         # Samples per byte
         spb = 8 // self.bitdepth
-        out = bytearray()
-        mask = 2**self.bitdepth - 1
-        shifts = [self.bitdepth * i
-                  for i in reversed(list(range(spb)))]
-        for o in bs:
-            out.extend([mask & (o >> i) for i in shifts])
-        return out[:width]
+        start = x0 // spb
+        skip = x0 - start * spb
+        values = self._bytes_to_values(
+            bs[start: (x1 + spb - 1) // spb], width=skip + x1 - x0)
+        return values[skip:]
 
-    def _iter_straight_packed(self, byte_blocks):
+    def _iter_straight_packed(self, byte_blocks, nrows=None):
         """Iterator that undoes the effect of filtering;
         yields each row as a sequence of packed bytes.
         Assumes input is straightlaced.
         `byte_blocks` should be an iterable that yields the raw bytes
         in blocks of arbitrary size.
+        If `nrows` is given, only that many rows are yielded
+        and `byte_blocks` is not read any further than needed for them.
         """
 
         # length of row, in bytes
         rb = self.row_bytes
-        a = bytearray()
+        engine = unfilter_engines[self.unfilter]
+        fu = max(1, self.psize)
+        # Scanlines are collected in `block` and their filters are
+        # undone in batches.  The same `block` is refilled
+        # for every batch, so the memory used depends only on
+        # the row size, not on the size of the blocks in `byte_blocks`.
+        batch = UNFILTER_BATCH_ROWS
+        if nrows is not None:
+            batch = max(1, min(batch, nrows))
+        block = bytearray(batch * (rb + 1))
+        view = memoryview(block)
+        # Number of bytes of `block` filled so far.
+        filled = 0
         # The previous (reconstructed) scanline.
         # None indicates first line of image.
         recon = None
+
+        def unfiltered():
+            """Undo the filters of the scanlines in `block`
+            and yield each one, as a new ``bytearray``."""
+            nonlocal recon
+            engine(block, 0, filled // (rb + 1), rb, fu, recon)
+            # The last scanline is kept apart from the one yielded,
+            # which the caller is free to change.
+            if filled:
+                recon = block[filled - rb: filled]
+            for start in range(0, filled, rb + 1):
+                yield block[start + 1: start + 1 + rb]
+
+        # Number of bytes still wanted, or None for all of them.
+        wanted = None
+        if nrows is not None:
+            wanted = nrows * (rb + 1)
         for some_bytes in byte_blocks:
-            a.extend(some_bytes)
-            while len(a) >= rb + 1:
-                filter_type = a[0]
-                scanline = a[1: rb + 1]
-                del a[: rb + 1]
-                recon = self.undo_filter(filter_type, scanline, recon)
-                yield recon
-        if len(a) != 0:
+            source = memoryview(some_bytes)
+            if wanted is not None:
+                source = source[:wanted]
+                wanted -= len(source)
+            while len(source):
+                n = min(len(source), len(block) - filled)
+                view[filled: filled + n] = source[:n]
+                filled += n
+                source = source[n:]
+                if filled == len(block):
+                    yield from unfiltered()
+                    filled = 0
+            if wanted == 0:
+                break
+        if filled % (rb + 1) != 0:
             # :file:format We get here with a file format error:
             # when the available bytes (after decompressing) do not
             # pack into exact rows.
             raise FormatError('Wrong size for decompressed IDAT chunk.')
-        assert len(a) == 0
+        yield from unfiltered()
 
     def validate_signature(self):
         """
@@ -1651,7 +2277,9 @@ class Reader:
         method = '_process_' + type.decode('ascii')
         m = getattr(self, method, None)
         if m:
-            m(data)
+            # A copy, so that a memory mapped file is not
+            # kept mapped by the metadata.
+            m(bytes(data))
 
     def _process_IHDR(self, data):
         # http://www.w3.org/TR/PNG/#11IHDR
@@ -1788,30 +2416,22 @@ class Reader:
         checksum failures will raise warnings rather than exceptions.
         """
 
-        def iteridat():
-            """Iterator that yields all the ``IDAT`` chunks as strings."""
-            while True:
-                type, data = self.chunk(lenient=lenient)
-                if type == b'IEND':
-                    # http://www.w3.org/TR/PNG/#11IEND
-                    break
-                if type != b'IDAT':
-                    continue
-                # type == b'IDAT'
-                # http://www.w3.org/TR/PNG/#11IDAT
-                if self.colormap and not self.plte:
-                    warnings.warn("PLTE chunk is required before IDAT chunk")
-                yield data
-
         self.preamble(lenient=lenient)
-        raw = decompress(iteridat())
+        if self.downscale and self.memory_budget is not None:
+            for shrink in (1, 2, 4, 8):
+                if self.memory_needed(shrink) <= self.memory_budget:
+                    break
+            if shrink > 1:
+                return self.read_reduced(shrink, lenient=lenient)
+        self._check_budget(self.memory_needed())
 
         if self.interlace:
             def rows_from_interlace():
                 """Yield each row from an interlaced PNG."""
                 # It's important that this iterator doesn't read
                 # IDAT chunks until it yields the first row.
-                bs = bytearray(itertools.chain(*raw))
+                bs = fill_buffer(self._inflate(lenient=lenient),
+                                 bytearray(self._filtered_size()))
                 arraycode = 'BH'[self.bitdepth > 8]
                 # Like :meth:`group` but
                 # producing an array.array object for each row.
@@ -1822,7 +2442,258 @@ class Reader:
                     yield row
             rows = rows_from_interlace()
         else:
-            rows = self._iter_bytes_to_values(self._iter_straight_packed(raw))
+            # Decompressed in windows of whole batches of scanlines
+            # (see _iter_straight_packed).
+            raw = self._inflate(
+                lenient=lenient,
+                max_length=UNFILTER_BATCH_ROWS * (self.row_bytes + 1))
+            rows = self._iter_straight_values(raw)
+        return self.width, self.height, rows, self._info()
+
+    def read_rows(self, y0, y1, x0=None, x1=None, lenient=False):
+        """
+        Read the PNG file and decode just a region of it:
+        the rows from `y0` up to (but not including) `y1`, and
+        if they are given, the columns from `x0` up to `x1`.
+        Returns (*width*, *height*, *rows*, *info*) like :meth:`read`,
+        but describing the region:
+        *width* is ``x1 - x0``, *height* is ``y1 - y0``,
+        and ``info['size']`` is that pair.
+
+        For a straightlaced image the rows above `y0` still
+        have their filters undone (each row depends on the one above),
+        but are not converted to values;
+        neither are the columns outside the region.
+        No ``IDAT`` data after row `y1` is read or decompressed.
+        An interlaced image is decoded whole and then cropped.
+        """
+
+        self.preamble(lenient=lenient)
+        if x0 is None:
+            x0 = 0
+        if x1 is None:
+            x1 = self.width
+        if not (0 <= y0 < y1 <= self.height and
+                0 <= x0 < x1 <= self.width):
+            raise ProtocolError(
+                "region from (%d, %d) to (%d, %d) is not within "
+                "the %dx%d image" %
+                (x0, y0, x1, y1, self.width, self.height))
+
+        if self.interlace:
+            self._check_budget(self.memory_needed())
+            rows = self.read(lenient=lenient)[2]
+            rows = (row[x0 * self.planes: x1 * self.planes]
+                    for row in itertools.islice(rows, y0, y1))
+        else:
+            self._check_budget(
+                (x1 - x0) * (y1 - y0) * self.planes * self._value_size())
+            window = min(UNFILTER_BATCH_ROWS, y1) * (self.row_bytes + 1)
+            raw = self._inflate(lenient=lenient, max_length=window)
+            packed = itertools.islice(
+                self._iter_straight_packed(raw, nrows=y1), y0, None)
+            rows = (self._bytes_to_values_window(row, x0, x1)
+                    for row in packed)
+        info = self._info()
+        info['size'] = (x1 - x0, y1 - y0)
+        return x1 - x0, y1 - y0, rows, info
+
+    def read_reduced(self, shrink, lenient=False):
+        """
+        Read the PNG file and decode a smaller version of it,
+        reduced by `shrink` (which must be 1, 2, 4, or 8)
+        in each direction.
+        Returns (*width*, *height*, *rows*, *info*) like :meth:`read`,
+        where *width* and *height* are those of the reduced image
+        (the full size divided by `shrink`, rounded up),
+        and ``info['size']`` is that pair.
+
+        For an interlaced image this is cheap:
+        the pixels whose coordinates are both multiples of `shrink`
+        are exactly those of the first few Adam7 passes,
+        so only those passes are decompressed and unfiltered
+        and the reduced image is point sampled from them.
+        ``IDAT`` data for the later passes is not read.
+
+        For a straightlaced image every scanline is still decoded
+        (each row depends on the one above),
+        and each `shrink` by `shrink` box of pixels is averaged,
+        rounding to nearest;
+        boxes at the right and bottom edges may be smaller.
+        A colour mapped image is point sampled instead,
+        since an average of palette indexes is meaningless.
+        """
+
+        self.preamble(lenient=lenient)
+        if shrink not in adam7_reduced_passes:
+            raise ProtocolError(
+                "shrink must be 1, 2, 4, or 8, not %r" % (shrink,))
+        width = (self.width + shrink - 1) // shrink
+        height = (self.height + shrink - 1) // shrink
+        self._check_budget(self.memory_needed(shrink))
+
+        if self.interlace:
+            def rows_from_interlace():
+                """Yield each row of the reduced interlaced PNG."""
+                passes = adam7_reduced_passes[shrink]
+                bs = fill_buffer(
+                    self._inflate(lenient=lenient),
+                    bytearray(self._filtered_size(passes)),
+                    complete=passes == len(adam7))
+                arraycode = 'BH'[self.bitdepth > 8]
+                values = self._deinterlace(bs, shrink)
+                vpr = width * self.planes
+                for i in range(0, len(values), vpr):
+                    yield array(arraycode, values[i:i+vpr])
+            rows = rows_from_interlace()
+        else:
+            raw = self._inflate(
+                lenient=lenient,
+                max_length=UNFILTER_BATCH_ROWS * (self.row_bytes + 1))
+            rows = self._iter_straight_values(raw)
+            if shrink > 1:
+                rows = self._iter_shrink(rows, shrink)
+        info = self._info()
+        info['size'] = (width, height)
+        return width, height, rows, info
+
+    def _iter_shrink(self, rows, shrink):
+        """
+        Iterator that reduces the full size `rows` of values
+        by `shrink` in each direction;
+        see :meth:`read_reduced`.
+        """
+
+        if self.colormap:
+            for y, row in enumerate(rows):
+                if y % shrink == 0:
+                    yield row[::shrink]
+            return
+
+        planes = self.planes
+        arraycode = 'BH'[self.bitdepth > 8]
+        width = (self.width + shrink - 1) // shrink
+        # Number of columns in each box.
+        columns = [min(shrink, self.width - x)
+                   for x in range(0, self.width, shrink)]
+        # Makes the last box full width, so that
+        # every box is `step` values apart in the column sums.
+        pad = [0] * ((width * shrink - self.width) * planes)
+        step = shrink * planes
+
+        rows = iter(rows)
+        while True:
+            band = list(itertools.islice(rows, shrink))
+            if not band:
+                return
+            # Sum of each value down the band of rows.
+            sums = list(map(sum, zip(*band))) + pad
+            counts = [len(band) * c for c in columns]
+            out = array(arraycode, [0] * (width * planes))
+            for i in range(planes):
+                total = sums[i::step]
+                for k in range(1, shrink):
+                    j = k * planes + i
+                    total = list(map(operator.add, total, sums[j::step]))
+                out[i::planes] = array(
+                    arraycode,
+                    [(t + c // 2) // c for t, c in zip(total, counts)])
+            yield out
+
+    def _inflate(self, lenient=False, max_length=INFLATE_WINDOW):
+        """
+        Iterator that yields the decompressed ``IDAT`` data,
+        at most `max_length` bytes at a time (see :func:`decompress`).
+        When the Reader is pipelined,
+        reading and decompressing run ahead on worker threads.
+        """
+
+        idat = self._iter_idat(lenient=lenient)
+        if not self.pipeline:
+            blocks = decompress(idat, max_length=max_length)
+        else:
+            blocks = run_ahead(decompress(run_ahead(idat),
+                                          max_length=max_length))
+        return self._iter_capped(blocks)
+
+    def _iter_capped(self, blocks):
+        """
+        Iterator that yields the decompressed `blocks`,
+        but raises :class:`FormatError` as soon as they add up to
+        more than the ``IHDR`` chunk implies;
+        so that a decompression bomb stops early.
+        """
+
+        limit = self._filtered_size()
+        n = 0
+        for block in blocks:
+            n += len(block)
+            if n > limit:
+                raise FormatError(
+                    "Decompressed IDAT data is larger than "
+                    "the %d bytes the IHDR chunk implies." % limit)
+            yield block
+
+    def memory_needed(self, shrink=1, whole=False):
+        """
+        Estimate, from the ``IHDR`` chunk, the memory in bytes
+        needed to decode the image
+        (reduced by `shrink`, see :meth:`read_reduced`):
+        the decoded values, at a byte each
+        (2 bytes when the bit depth is 16),
+        plus the decompressed ``IDAT`` data when that is all held at once,
+        which it is for an interlaced image or
+        (when `whole` is true) for :meth:`read_ndarray`.
+        The overhead of Python objects for each row is not included.
+        """
+
+        self.preamble()
+        width = (self.width + shrink - 1) // shrink
+        height = (self.height + shrink - 1) // shrink
+        size = width * height * self.planes * self._value_size()
+        if self.interlace or whole:
+            size += self._filtered_size(adam7_reduced_passes[shrink])
+        return size
+
+    def _value_size(self):
+        """The bytes taken by each decoded value."""
+
+        return 1 + (self.bitdepth > 8)
+
+    def _check_budget(self, needed):
+        """
+        Raise :class:`MemoryBudgetError` if
+        `needed` bytes is over the Reader's memory budget.
+        """
+
+        if self.memory_budget is not None and needed > self.memory_budget:
+            raise MemoryBudgetError(
+                "decoding needs about %d bytes, "
+                "over the memory budget of %d bytes" %
+                (needed, self.memory_budget))
+
+    def _iter_idat(self, lenient=False):
+        """Iterator that yields all the ``IDAT`` chunks as strings."""
+
+        while True:
+            type, data = self.chunk(lenient=lenient)
+            if type == b'IEND':
+                # http://www.w3.org/TR/PNG/#11IEND
+                break
+            if type != b'IDAT':
+                continue
+            # type == b'IDAT'
+            # http://www.w3.org/TR/PNG/#11IDAT
+            if self.colormap and not self.plte:
+                warnings.warn("PLTE chunk is required before IDAT chunk")
+            yield data
+
+    def _info(self):
+        """
+        The *info* dictionary describing the image,
+        as returned by :meth:`read` and friends.
+        """
+
         info = dict()
         for attr in 'greyscale alpha planes bitdepth interlace'.split():
             info[attr] = getattr(self, attr)
@@ -1837,7 +2708,7 @@ class Reader:
                                           self.unit_is_meter)
         if self.plte:
             info['palette'] = self.palette()
-        return self.width, self.height, rows, info
+        return info
 
     def read_flat(self):
         """
@@ -1857,6 +2728,97 @@ class Reader:
         pixel = array(arraycode, itertools.chain(*pixel))
         return x, y, pixel, info
 
+    def read_ndarray(self, lenient=False):
+        """
+        Read the PNG file and decode it into a single ``numpy`` array.
+        Returns (*width*, *height*, *pixels*, *info*).
+
+        *pixels* is a C-contiguous array of shape
+        ``(height, width, planes)``;
+        its dtype is ``uint8``, or ``uint16`` when the bit depth is 16.
+        Like :meth:`read` the values are not otherwise converted,
+        so a colour mapped image gives palette indexes.
+
+        The ``IDAT`` data is decompressed into one preallocated buffer
+        and unfiltered in place,
+        so unlike :meth:`read` no Python object is made for each row.
+
+        Requires ``numpy``.
+        """
+
+        import numpy
+
+        self.preamble(lenient=lenient)
+        self._check_budget(self.memory_needed(whole=True))
+        raw = fill_buffer(self._inflate(lenient=lenient),
+                          bytearray(self._filtered_size()))
+
+        shape = (self.height, self.width, self.planes)
+        dtype = (numpy.uint8, numpy.uint16)[self.bitdepth > 8]
+        if self.interlace:
+            values = self._deinterlace(raw)
+            pixels = numpy.frombuffer(values, dtype=dtype).reshape(shape)
+        else:
+            self._undo_filter_rows(raw)
+            pixels = numpy.empty(shape, dtype=dtype)
+            self._packed_to_ndarray(numpy, raw, pixels)
+        return self.width, self.height, pixels, self._info()
+
+    def _filtered_size(self, passes=7):
+        """
+        The size in bytes of the decompressed ``IDAT`` data,
+        including the filter type byte at the start of each scanline.
+        For an interlaced image, the size of just
+        the first `passes` passes.
+        """
+
+        if not self.interlace:
+            return self.height * (self.row_bytes + 1)
+        bits_per_pixel = self.bitdepth * self.planes
+        size = 0
+        for xstart, ystart, xstep, ystep, ppr, nrows, index in \
+                adam7_geometry(self.width, self.height):
+            if index < passes:
+                size += nrows * ((ppr * bits_per_pixel + 7) // 8 + 1)
+        return size
+
+    def _undo_filter_rows(self, raw):
+        """
+        Undo the filter of every scanline of a straightlaced image,
+        in place.
+        `raw` is the entire decompressed ``IDAT`` data;
+        the filter type bytes are left in place.
+        """
+
+        engine = unfilter_engines[self.unfilter]
+        engine(raw, 0, self.height, self.row_bytes, max(1, self.psize))
+
+    def _packed_to_ndarray(self, numpy, raw, pixels):
+        """
+        Convert the unfiltered scanlines in `raw`
+        (each one prefixed by its filter type byte)
+        into values, storing them in the ``numpy`` array `pixels`.
+        """
+
+        rb = self.row_bytes
+        if self.bitdepth == 16:
+            packed = numpy.ndarray((self.height, rb // 2), dtype='>u2',
+                                   buffer=raw, offset=1, strides=(rb + 1, 2))
+        else:
+            packed = numpy.ndarray((self.height, rb), dtype=numpy.uint8,
+                                   buffer=raw, offset=1, strides=(rb + 1, 1))
+        rows = pixels.reshape(self.height, self.width * self.planes)
+        if self.bitdepth >= 8:
+            rows[...] = packed
+            return
+        # Samples per byte
+        spb = 8 // self.bitdepth
+        mask = 2**self.bitdepth - 1
+        shifts = numpy.arange(8 - self.bitdepth, -1, -self.bitdepth,
+                              dtype=numpy.uint8)
+        values = (packed[:, :, numpy.newaxis] >> shifts) & mask
+        rows[...] = values.reshape(self.height, rb * spb)[:, :self.width]
+
     def palette(self, alpha='natural'):
         """
         Returns a palette that is a sequence of 3-tuples or 4-tuples,
@@ -1943,20 +2905,26 @@ class Reader:
             info['bitdepth'] = 8
             info['planes'] = 3 + bool(self.trns)
             plte = self.palette()
+            planes = len(plte[0])
+            # One table for each plane, mapping palette index to value
+            # (for use with ``bytes.translate``).
+            tables = [bytes(entry[i] for entry in plte).ljust(256, b'\0')
+                      for i in range(planes)]
 
             def iterpal(pixels):
                 for row in pixels:
-                    row = [plte[x] for x in row]
-                    yield array('B', itertools.chain(*row))
+                    row = bytes(row)
+                    if row and max(row) >= len(plte):
+                        raise FormatError(
+                            "palette index %d is out of range "
+                            "for a palette of %d entries" %
+                            (max(row), len(plte)))
+                    a = bytearray(len(row) * planes)
+                    for i, table in enumerate(tables):
+                        a[i::planes] = row.translate(table)
+                    yield a
             pixels = iterpal(pixels)
         elif self.trns:
-            # It would be nice if there was some reasonable way
-            # of doing this without generating a whole load of
-            # intermediate tuples.  But tuples does seem like the
-            # easiest way, with no other way clearly much simpler or
-            # much faster.  (Actually, the L to LA conversion could
-            # perhaps go faster (all those 1-tuples!), but I still
-            # wonder whether the code proliferation is worth it)
             it = self.transparent
             maxval = 2 ** info['bitdepth'] - 1
             planes = info['planes']
@@ -1966,18 +2934,37 @@ class Reader:
 
             def itertrns(pixels):
                 for row in pixels:
-                    # For each row we group it into pixels, then form a
-                    # characterisation vector that says whether each
-                    # pixel is opaque or not.  Then we convert
-                    # True/False to 0/maxval (by multiplication),
-                    # and add it as the extra channel.
-                    row = group(row, planes)
-                    opa = map(it.__ne__, row)
-                    opa = map(maxval.__mul__, opa)
-                    opa = list(zip(opa))    # convert to 1-tuples
-                    yield array(
-                        typecode,
-                        itertools.chain(*map(operator.add, row, opa)))
+                    if typecode == 'B':
+                        row = bytes(row)
+                    # A mask with a 1 for each pixel that is
+                    # the transparent colour, and 0 otherwise:
+                    # the masks for each channel are ANDed together
+                    # as big integers.
+                    n = len(row) // planes
+                    transparent = -1
+                    for i in range(planes):
+                        transparent &= int.from_bytes(
+                            equal_mask(row[i::planes], it[i]), 'big')
+                    transparent = (transparent & ((1 << 8 * n) - 1))
+                    opaque = transparent.to_bytes(n, 'big').translate(
+                        opaque_table)
+                    if typecode == 'H':
+                        a = array('H', bytes(2 * (len(row) + n)))
+                    else:
+                        a = bytearray(len(row) + n)
+                    for i in range(planes):
+                        a[i::planes + 1] = row[i::planes]
+                    if typecode == 'H':
+                        opaque = array('H', map(maxval.__mul__, opaque))
+                    else:
+                        opaque = opaque.translate(alpha_table)
+                    a[planes::planes + 1] = opaque
+                    yield a
+            # Maps the mask to 1 for an opaque pixel, 0 otherwise;
+            # then to the alpha value.
+            opaque_table = bytes([1, 0]).ljust(256, b'\0')
+            if typecode == 'B':
+                alpha_table = bytes([0, maxval]).ljust(256, b'\0')
             pixels = itertrns(pixels)
         targetbitdepth = None
         if self.sbit:
@@ -1994,7 +2981,15 @@ class Reader:
 
             def itershift(pixels):
                 for row in pixels:
-                    yield [p >> shift for p in row]
+                    if isinstance(row, (bytes, bytearray)):
+                        yield row.translate(table)
+                    elif targetbitdepth <= 8:
+                        # Shifted 16-bit values fit in bytes now.
+                        yield bytearray(map(shift.__rrshift__, row))
+                    else:
+                        yield array(row.typecode,
+                                    map(shift.__rrshift__, row))
+            table = bytes(p >> shift for p in range(256))
             pixels = itershift(pixels)
         return x, y, pixels, info
 
@@ -2002,7 +2997,8 @@ class Reader:
         """Helper used by :meth:`asRGB8` and :meth:`asRGBA8`."""
 
         width, height, pixels, info = get()
-        maxval = 2**info['bitdepth'] - 1
+        bitdepth = info['bitdepth']
+        maxval = 2**bitdepth - 1
         targetmaxval = 2**targetbitdepth - 1
         factor = float(targetmaxval) / float(maxval)
         info['bitdepth'] = targetbitdepth
@@ -2010,8 +3006,17 @@ class Reader:
         def iterscale():
             for row in pixels:
                 yield [int(round(x * factor)) for x in row]
+
+        def itertable():
+            # Each value is looked up (not computed),
+            # including for a 16-bit source.
+            table = rescale_table(bitdepth, targetbitdepth)
+            for row in pixels:
+                yield bytearray(map(table.__getitem__, row))
         if maxval == targetmaxval:
             return width, height, pixels, info
+        elif targetbitdepth <= 8:
+            return width, height, itertable(), info
         else:
             return width, height, iterscale(), info
 
@@ -2145,24 +3150,351 @@ class Reader:
         info['planes'] = 4
         return width, height, convert(), info
 
+    def asGreyscale8(self):
+        """
+        Return the image as greyscale pixels with 8-bits per sample.
+        Colour images (including colour mapped ones) are converted
+        to luma, Y' = 0.299 R' + 0.587 G' + 0.114 B',
+        using integer weights in 16-bit fixed point
+        (so a result may differ by 1 from rounding the exact sum);
+        greyscale images are passed through.
+        Values are rescaled to the range 0 to 255 like :meth:`asRGB8`.
+        An alpha channel in the source image is discarded.
+
+        The return values are as for the :meth:`read` method except that
+        the *info* reflect the returned pixels, not the source image.
+        In particular, for this method
+        ``info['greyscale']`` will be ``True``,
+        ``info['alpha']`` will be ``False``, and
+        ``info['bitdepth']`` will be 8.
+        Each row is a ``bytearray``.
+        """
+
+        width, height, pixels, info = self.asDirect()
+        planes = info['planes']
+        bitdepth = info['bitdepth']
+        maxval = 2 ** bitdepth - 1
+        # Rescales a value at the direct bit depth to 8 bits.
+        if maxval == 255:
+            scale = None
+        else:
+            scale = rescale_table(bitdepth)
+        info['greyscale'] = True
+        info['alpha'] = False
+        info['planes'] = 1
+        info['bitdepth'] = 8
+
+        if planes <= 2 and scale is None:
+            def convert():
+                for row in pixels:
+                    yield bytearray(row[::planes])
+        elif planes <= 2:
+            def convert():
+                for row in pixels:
+                    yield bytearray(map(scale.__getitem__, row[::planes]))
+        else:
+            return width, height, luma8_rows(pixels, planes, bitdepth), info
+        return width, height, convert(), info
+
+
+def luma8_rows(pixels, planes, bitdepth=8):
+    """
+    Convert rows of colour pixels (`planes` values per pixel,
+    red, green, and blue first, any alpha ignored)
+    at `bitdepth` bits per value to rows of 8-bit luma,
+    Y' = 0.299 R' + 0.587 G' + 0.114 B',
+    as :meth:`Reader.asGreyscale8` does.
+    Yields a ``bytearray`` for each row.
+    """
+
+    maxval = 2 ** bitdepth - 1
+    # Weights in 16-bit fixed point, summing to 1 << 16.
+    # Each weight is premultiplied into a table of
+    # all the possible values;
+    # the red table also carries the rounding term.
+    values = range(maxval + 1)
+    red = [19595 * v + 32768 for v in values]
+    green = [38470 * v for v in values]
+    blue = [7471 * v for v in values]
+    if maxval == 255:
+        scale = None
+    else:
+        scale = rescale_table(bitdepth)
+
+    for row in pixels:
+        y = [(red[r] + green[g] + blue[b]) >> 16
+             for r, g, b in zip(row[0::planes],
+                                row[1::planes],
+                                row[2::planes])]
+        if scale is not None:
+            y = map(scale.__getitem__, y)
+        yield bytearray(y)
+
+
+def probe(path, chunks=False):
+    """
+    Read just the signature and ``IHDR`` chunk of the PNG file
+    at `path`, and return a :class:`Probe`:
+    (*width*, *height*, *bitdepth*, *color_type*, *interlace*, *chunks*).
+    No other chunk is read or checked,
+    so this is much quicker than :meth:`Reader.preamble`
+    for finding the size and format of many files.
+
+    If `chunks` is true, *chunks* is the list of
+    (*type*, *offset*, *length*) triples from
+    :meth:`Reader.chunk_offsets`
+    (only the chunk headers are read);
+    otherwise it is ``None``.
+
+    Raises :class:`FormatError` if the file is not a PNG file
+    or its ``IHDR`` chunk is not valid.
+    """
+
+    with open(path, 'rb') as f:
+        r = Reader(file=f)
+        type, data = r.chunk()
+        if type != b'IHDR':
+            raise FormatError(
+                "First chunk is %r, not IHDR." % type)
+        r._process_IHDR(data)
+        offsets = r.chunk_offsets() if chunks else None
+    return Probe(r.width, r.height, r.bitdepth, r.color_type,
+                 r.interlace, offsets)
+
+
+def probe_many(paths, threads=8, chunks=False):
+    """
+    :func:`probe` many PNG files at once, on a pool of `threads` threads
+    (most of the time goes on opening files, which releases the GIL).
+    `paths` is either a sequence of paths,
+    or the path of a directory,
+    in which case its files whose names end in ``.png``
+    (in any case) are probed, in sorted order,
+    or the path of a single file.
+
+    Returns a list of (*path*, *result*) pairs, in order,
+    where *result* is the :class:`Probe` or,
+    when the file cannot be probed,
+    the exception (:class:`Error` or ``OSError``) that was raised.
+    """
+
+    if isinstance(paths, (str, bytes, os.PathLike)):
+        if os.path.isdir(paths):
+            paths = sorted(entry.path for entry in os.scandir(paths)
+                           if entry.is_file() and
+                           os.fsdecode(entry.name).lower().endswith('.png'))
+        else:
+            paths = [paths]
+
+    def probe_one(path):
+        try:
+            return probe(path, chunks=chunks)
+        except (Error, OSError) as e:
+            return e
+
+    paths = list(paths)
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        return list(zip(paths, executor.map(probe_one, paths)))
+
+
+class BufferFile:
+    """
+    A read-only, seekable, file-like object over a buffer:
+    ``bytes``, ``bytearray``, ``mmap.mmap``,
+    or anything else supporting the buffer protocol.
+    :meth:`read` returns a ``memoryview`` of the buffer;
+    no data is copied.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.view = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def read(self, n=-1):
+        start = self.position
+        if n is None or n < 0:
+            end = len(self.view)
+        else:
+            end = min(len(self.view), start + n)
+        self.position = max(start, end)
+        return self.view[start:end]
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.view.release()
+        close = getattr(self.buffer, 'close', None)
+        if close:
+            close()
+
+
+def map_file(filename):
+    """
+    Memory map the named file, read only.
+    Returns an ``mmap.mmap`` object
+    (or empty ``bytes`` for an empty file, which cannot be mapped).
+    """
+
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
 
-def decompress(data_blocks):
+def decompress(data_blocks, max_length=None):
     """
     `data_blocks` should be an iterable that
     yields the compressed data (from the ``IDAT`` chunks).
     This yields decompressed byte strings.
+
+    Without `max_length` there is one yield per ``IDAT`` chunk,
+    however large that chunk is once decompressed.
+    With `max_length` no byte string yielded is longer than that;
+    compressed data that would decompress to more is
+    kept (by ``zlib``) until the next yield.
+    Each chunk is fed to ``zlib`` in slices of `max_length` bytes,
+    because ``zlib`` copies all the input it has not yet used
+    (its ``unconsumed_tail``) on every call;
+    copying the rest of a large chunk
+    for each window of output would take time quadratic in
+    the size of the chunk.
     """
 
-    # Currently, with no max_length parameter to decompress,
-    # this routine will do one yield per IDAT chunk: Not very
-    # incremental.
     d = zlib.decompressobj()
-    # Each IDAT chunk is passed to the decompressor, then any
-    # remaining state is decompressed out.
+    if not max_length:
+        # Each IDAT chunk is passed to the decompressor, then any
+        # remaining state is decompressed out.
+        for data in data_blocks:
+            yield bytearray(d.decompress(data))
+        yield bytearray(d.flush())
+        return
+
     for data in data_blocks:
-        # :todo: add a max_length argument here to limit output size.
-        yield bytearray(d.decompress(data))
-    yield bytearray(d.flush())
+        data = memoryview(data)
+        for i in range(0, len(data), max_length):
+            piece = data[i: i + max_length]
+            while piece:
+                some_bytes = d.decompress(piece, max_length)
+                piece = d.unconsumed_tail
+                if some_bytes:
+                    yield some_bytes
+    # There may still be output held by the decompressor
+    # when all the input has been consumed.
+    while True:
+        some_bytes = d.decompress(b'', max_length)
+        if not some_bytes:
+            break
+        yield some_bytes
+    some_bytes = d.flush()
+    if some_bytes:
+        yield some_bytes
+
+
+def decompress_into(data_blocks, buffer, complete=True):
+    """
+    Like :func:`decompress`, but rather than yielding byte strings
+    the decompressed data is written into `buffer`,
+    a preallocated ``bytearray`` (or other writable buffer)
+    that must be exactly the size of the decompressed data.
+    Returns `buffer`.
+
+    If `complete` is false, only the start of the decompressed data
+    is wanted: decompression stops once `buffer` is full,
+    and `data_blocks` is not read any further.
+    """
+
+    return fill_buffer(decompress(data_blocks, max_length=INFLATE_WINDOW),
+                       buffer, complete)
+
+
+def fill_buffer(blocks, buffer, complete=True):
+    """
+    Copy the decompressed ``IDAT`` data in `blocks`,
+    an iterable of byte strings, into `buffer`;
+    see :func:`decompress_into`.
+    Returns `buffer`.
+    """
+
+    target = memoryview(buffer)
+    n = 0
+    for some_bytes in blocks:
+        if n + len(some_bytes) > len(target):
+            if not complete:
+                target[n:] = some_bytes[: len(target) - n]
+                return buffer
+            raise FormatError('Wrong size for decompressed IDAT chunk.')
+        target[n: n + len(some_bytes)] = some_bytes
+        n += len(some_bytes)
+        if not complete and n == len(target):
+            return buffer
+    if n != len(target):
+        raise FormatError('Wrong size for decompressed IDAT chunk.')
+    return buffer
+
+
+def run_ahead(iterable, depth=PIPELINE_DEPTH):
+    """
+    Iterate over `iterable` on a worker thread, and
+    yield its items as they arrive,
+    through a queue that lets the worker run up to
+    `depth` items ahead.
+    An exception raised by `iterable` is raised again
+    when its place in the sequence is reached.
+    If iteration stops early (the generator is closed),
+    the worker stops too.
+    """
+
+    q = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up if the consumer has gone away.
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except BaseException as e:
+            put((False, e))
+        else:
+            put((False, None))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close:
+                close()
+
+    thread = threading.Thread(target=work, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = q.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
 
 
 def check_bitdepth_colortype(bitdepth, colortype):
@@ -2267,6 +3599,323 @@ def undo_filter_paeth(filter_unit, scanline, previous, result):
         ai += 1
 
 
+def filter_scanline(filter_type, line, fo, prev=None):
+    """
+    Apply a scanline filter to a scanline and return the result,
+    a ``bytearray`` (without the filter type byte).
+    `filter_type` is the filter type (0 to 4);
+    `line` is the current (unfiltered) scanline, as a sequence of bytes;
+    `fo` is the filter unit, the number of bytes per complete pixel
+    (at least 1);
+    `prev` is the previous (unfiltered) scanline,
+    or ``None`` for the first scanline of an image or pass.
+    This is the inverse of :func:`undo_filter_scanline`.
+    """
+
+    line = bytearray(line)
+    if filter_type == 0:
+        return line
+    if prev is None:
+        prev = bytes(len(line))
+
+    # The byte to the left of each byte of the scanline,
+    # or 0 for those in the first pixel.
+    left = bytes(fo) + line[:-fo]
+
+    if filter_type == 1:
+        return bytearray((x - a) & 0xff for x, a in zip(line, left))
+    if filter_type == 2:
+        return bytearray((x - b) & 0xff for x, b in zip(line, prev))
+    if filter_type == 3:
+        return bytearray((x - ((a + b) >> 1)) & 0xff
+                         for x, a, b in zip(line, left, prev))
+    if filter_type != 4:
+        raise FormatError(
+            'Invalid PNG Filter Type.  '
+            'See http://www.w3.org/TR/2003/REC-PNG-20031110/#9Filters .')
+
+    upleft = bytes(fo) + bytes(prev[:-fo])
+    result = bytearray(len(line))
+    for i, (x, a, b, c) in enumerate(zip(line, left, prev, upleft)):
+        p = a + b - c
+        pa = abs(p - a)
+        pb = abs(p - b)
+        pc = abs(p - c)
+        if pa <= pb and pa <= pc:
+            pr = a
+        elif pb <= pc:
+            pr = b
+        else:
+            pr = c
+        result[i] = (x - pr) & 0xff
+    return result
+
+
+# The magnitude of each byte when taken as a signed (two's complement)
+# value; used to score a filtered scanline.
+_signed_magnitude = bytes(min(v, 256 - v) for v in range(256))
+
+
+def filter_scanline_adaptive(line, fo, prev=None):
+    """
+    Filter a scanline with each filter type in turn and
+    choose the result with the minimum sum of absolute differences,
+    taking each filtered byte as a signed value.
+    Returns a pair (*filter_type*, *filtered*).
+    The arguments are as for :func:`filter_scanline`.
+    """
+
+    best = None
+    for filter_type in range(5):
+        filtered = filter_scanline(filter_type, line, fo, prev)
+        score = sum(filtered.translate(_signed_magnitude))
+        if best is None or score < best[0]:
+            best = score, filter_type, filtered
+    return best[1:]
+
+
+def undo_filter_scanline(filter_type, filter_unit, scanline, previous):
+    """
+    Undo the filter for a single scanline, in place,
+    and return it.
+    `previous` is the reconstructed previous scanline,
+    or ``None`` for the first scanline of an image or pass.
+    See :meth:`Reader.undo_filter`.
+    """
+
+    if filter_type == 0:
+        return scanline
+
+    if filter_type not in (1, 2, 3, 4):
+        raise FormatError(
+            'Invalid PNG Filter Type.  '
+            'See http://www.w3.org/TR/2003/REC-PNG-20031110/#9Filters .')
+
+    # For the first line of a pass, synthesize a dummy previous
+    # line.  An alternative approach would be to observe that on the
+    # first line 'up' is the same as 'null', 'paeth' is the same
+    # as 'sub', with only 'average' requiring any special case.
+    if not previous:
+        previous = bytearray(len(scanline))
+
+    # Call appropriate filter algorithm.  Note that 0 has already
+    # been dealt with.
+    fn = (None,
+          undo_filter_sub,
+          undo_filter_up,
+          undo_filter_average,
+          undo_filter_paeth)[filter_type]
+    fn(filter_unit, scanline, previous, scanline)
+    return scanline
+
+
+def undo_filter_rows_python(raw, offset, nrows, row_bytes, filter_unit,
+                            previous=None):
+    """
+    Undo the filters of `nrows` consecutive scanlines, in place.
+    The scanlines start at `offset` in `raw` (a ``bytearray``);
+    each one is `row_bytes` long and
+    is preceded by its filter type byte (which is left alone).
+    `previous` is the reconstructed scanline
+    that precedes the first one, or ``None``.
+
+    This is the reference implementation,
+    which loops over every byte in Python.
+    """
+
+    view = memoryview(raw)
+    for start in range(offset, offset + nrows * (row_bytes + 1),
+                       row_bytes + 1):
+        scanline = view[start + 1: start + 1 + row_bytes]
+        undo_filter_scanline(raw[start], filter_unit, scanline, previous)
+        previous = scanline
+
+
+# A run of scanlines is reconstructed as a wavefront (see
+# :func:`undo_filter_rows_numpy`) when it has at least this many
+# Average or Paeth filtered bytes for each anti-diagonal it spans;
+# below that the Python loops are quicker.
+WAVEFRONT_BYTES_PER_STEP = 100
+
+# The most scanlines reconstructed in one wavefront.
+WAVEFRONT_MAX_ROWS = 512
+
+
+def undo_filter_rows_numpy(raw, offset, nrows, row_bytes, filter_unit,
+                           previous=None):
+    """
+    Batched version of :func:`undo_filter_rows_python`
+    that uses ``numpy`` array operations.
+
+    None and Up scanlines are a copy or a single array add;
+    Sub scanlines are a cumulative sum down each column of
+    the scanline viewed as an array of filter units.
+    Average and Paeth depend on the reconstructed byte to the left,
+    so they are done as a wavefront over a run of scanlines:
+    each pixel depends only on pixels in the two preceding
+    anti-diagonals, so a whole anti-diagonal is reconstructed at once.
+    Scanlines using Average or Paeth that are too few to make a
+    wavefront worthwhile fall back to the Python loops.
+    """
+
+    import numpy
+
+    fu = filter_unit
+    block = numpy.ndarray((nrows, row_bytes + 1), dtype=numpy.uint8,
+                          buffer=raw, offset=offset)
+    filter_types = block[:, 0]
+    if nrows and filter_types.max() > 4:
+        raise FormatError(
+            'Invalid PNG Filter Type.  '
+            'See http://www.w3.org/TR/2003/REC-PNG-20031110/#9Filters .')
+    lines = block[:, 1:]
+    if previous is None:
+        prior = numpy.zeros(row_bytes, dtype=numpy.uint8)
+    else:
+        prior = numpy.frombuffer(previous, dtype=numpy.uint8)
+    # Number of anti-diagonals across one scanline.
+    diagonals = row_bytes // fu
+    # Where each run of scanlines with the same filter type ends.
+    runs = numpy.append(
+        numpy.flatnonzero(numpy.diff(filter_types)) + 1, nrows)
+
+    y = 0
+    while y < nrows:
+        filter_type = filter_types[y]
+        if filter_type >= 3:
+            end = min(nrows, y + WAVEFRONT_MAX_ROWS)
+            slow = numpy.count_nonzero(filter_types[y:end] >= 3)
+            steps = end - y + diagonals
+            if slow * row_bytes >= WAVEFRONT_BYTES_PER_STEP * steps:
+                _undo_filter_wavefront(
+                    numpy, lines[y:end], filter_types[y:end], prior, fu)
+                prior = lines[end - 1]
+                y = end
+                continue
+            undo_filter_scanline(filter_type, fu,
+                                 memoryview(lines[y]), memoryview(prior))
+        else:
+            # A run of None, Sub, or Up scanlines is done in one go,
+            # which matters when scanlines are short and many.
+            end = runs[numpy.searchsorted(runs, y, side='right')]
+            if filter_type == 2:
+                numpy.add(lines[y], prior, out=lines[y])
+                numpy.cumsum(lines[y:end], axis=0, dtype=numpy.uint8,
+                             out=lines[y:end])
+            elif filter_type == 1:
+                units = lines[y:end].reshape(end - y, -1, fu)
+                lines[y:end] = numpy.cumsum(
+                    units, axis=1, dtype=numpy.uint8).reshape(end - y, -1)
+            prior = lines[end - 1]
+            y = end
+            continue
+        prior = lines[y]
+        y += 1
+
+
+def _undo_filter_wavefront(numpy, lines, filter_types, prior, fu):
+    """
+    Undo the filters of the scanlines in `lines`
+    (a 2-dimensional ``uint8`` array), in place,
+    one anti-diagonal of pixels at a time.
+    `prior` is the reconstructed scanline before the first one.
+    Any filter type may be used by the scanlines.
+    """
+
+    nrows, row_bytes = lines.shape
+    # Pixels (filter units) per scanline.
+    ppr = row_bytes // fu
+    # The working copy is stored skewed, one anti-diagonal after another,
+    # so that each anti-diagonal is contiguous in memory.
+    # Scanline q (the prior scanline is q = 0) and pixel x is
+    # at ``work[x + q, q]``; the pixels to the left and above
+    # are then in anti-diagonal x + q - 1, and above-left in x + q - 2.
+    # Entries outside the image stay zero, which is what the filters
+    # expect to the left of the first pixel;
+    # the last anti-diagonal is entirely outside the image, and
+    # is the one found at index -1 when d - 2 is negative.
+    work = numpy.zeros((ppr + nrows + 1, nrows + 1, fu), dtype=numpy.uint8)
+    skewed = numpy.ndarray(
+        (nrows + 1, ppr, fu), dtype=numpy.uint8, buffer=work,
+        strides=((nrows + 2) * fu, (nrows + 1) * fu, 1))
+    skewed[0] = prior.reshape(ppr, fu)
+    skewed[1:] = lines.reshape(nrows, ppr, fu)
+
+    present = set(numpy.unique(filter_types).tolist())
+    # For each filter type, a column that is 1 for the scanlines using it.
+    masks = dict((t, (filter_types == t).astype(numpy.int16)[:, numpy.newaxis])
+                 for t in present)
+
+    for d in range(1, ppr + nrows):
+        # Scanlines q0 to q1 - 1 have a pixel on anti-diagonal `d`.
+        q0 = max(1, d - ppr + 1)
+        q1 = min(nrows, d) + 1
+        x = work[d, q0:q1]
+        a = work[d - 1, q0:q1]
+        b = work[d - 1, q0 - 1:q1 - 1]
+        if present == {4}:
+            predictor = _paeth(numpy, a, b, work[d - 2, q0 - 1:q1 - 1])
+        elif present == {3}:
+            predictor = numpy.add(a, b, dtype=numpy.int16) >> 1
+        else:
+            # Only one term is not zero for each scanline.
+            predictor = 0
+            for t in present:
+                if t == 0:
+                    continue
+                elif t == 1:
+                    term = a
+                elif t == 2:
+                    term = b
+                elif t == 3:
+                    term = numpy.add(a, b, dtype=numpy.int16) >> 1
+                else:
+                    term = _paeth(numpy, a, b, work[d - 2, q0 - 1:q1 - 1])
+                predictor = predictor + term * masks[t][q0 - 1:q1 - 1]
+        # Arithmetic is modulo 256 by the cast back to uint8.
+        numpy.add(x, predictor, out=x, casting='unsafe')
+
+    lines[...] = skewed[1:].reshape(nrows, row_bytes)
+
+
+def _paeth(numpy, a, b, c):
+    """
+    The Paeth predictor for whole arrays of
+    left (`a`), above (`b`), and above-left (`c`) values.
+    """
+
+    # These are p - a, p - b, and p - c, where p = a + b - c.
+    pa = numpy.subtract(b, c, dtype=numpy.int16)
+    pb = numpy.subtract(a, c, dtype=numpy.int16)
+    pc = numpy.abs(pa + pb)
+    numpy.abs(pa, out=pa)
+    numpy.abs(pb, out=pb)
+    return numpy.where((pa <= pb) & (pa <= pc),
+                       a, numpy.where(pb <= pc, b, c))
+
+
+# The engines that can undo scanline filters,
+# see the `unfilter` argument of :class:`Reader`.
+unfilter_engines = {
+    'python': undo_filter_rows_python,
+    'numpy': undo_filter_rows_numpy,
+}
+
+
+def default_unfilter_engine():
+    """
+    The name of the engine in :data:`unfilter_engines`
+    used when a :class:`Reader` is not given one.
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        return 'python'
+    del numpy
+    return 'numpy'
+
+
 def convert_la_to_rgba(row, result):
     for i in range(3):
         result[i::4] = row[0::2]